@@ -1,66 +1,1698 @@
+import atexit
+import contextvars
 import glob
+import json
+import logging
 import numbers
+import os
+import random
 import re
 import shlex
 import sys
-import vapoursynth as vs
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager, nullcontext
 from fractions import Fraction
+from math import gcd
+from os import cpu_count
 from os.path import getsize, splitext
+from xml.sax.saxutils import escape
 
+try:
+    import vapoursynth as vs
+except ImportError:
+    # Only AudioCutter itself needs vapoursynth. Timeline works fine without it.
+    vs = None
 
-class AudioCutter(object):
-    """A tool to cut audio and generate associated chapters/qpfiles for vapoursynth."""
+# Easy, top of file spot for mkvmerge path. If the binary isn't in your PATH, edit it here.
+MKVMERGE = r'C:/Program Files/MKVtoolnix/mkvmerge.exe'
+
+_DELAY_RE = re.compile(r'DELAY ([-]?\d+)', flags=re.IGNORECASE)
+# mkvmerge's "Progress: 42%" lines, in whatever language it's set to
+_PROGRESS_RE = re.compile(rb'(\d+)%\s*$')
+
+# Sample rates by ADTS sampling_frequency_index
+_ADTS_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000,
+               7350)
+# AC3 sample rates by fscod, and frame sizes in 16-bit words by fscod and frmsizecod // 2
+_AC3_RATES = (48000, 44100, 32000)
+_AC3_WORDS = ((64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 448, 512, 640, 768, 896, 1024,
+               1152, 1280),
+              (69, 87, 104, 121, 139, 174, 208, 243, 278, 348, 417, 487, 557, 696, 835, 975, 1114,
+               1253, 1393),
+              (96, 120, 144, 168, 192, 240, 288, 336, 384, 480, 576, 672, 768, 960, 1152, 1344, 1536,
+               1728, 1920))
+
+
+class AudioCutterError(Exception):
+    """Raised by cut_audio_async() when the audio can't be cut, where cut_audio() would exit."""
+
+
+class MkvmergeError(AudioCutterError):
+    """mkvmerge failed. cmd is what was run, returncode its exit code, and output what it said."""
+
+    def __init__(self, cmd, returncode, output=''):
+        last_line = output.strip().splitlines()[-1:] or ['']
+        super().__init__("Failed to execute mkvmerge: {0:d} {1}".format(returncode,
+                                                                       last_line[0]).strip())
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+
+
+def _index_raw_audio(buf, codec):
+    """Finds the frame boundaries in a raw ADTS aac ('aac') or ac3 ('ac3') stream.
+
+    Returns (offsets, sample_rate, samples_per_frame), where offsets holds the start of every
+    frame followed by the end of the last one. Junk between frames is skipped, and a truncated
+    final frame is dropped. Returns None for anything it can't cut cleanly, like E-AC3 or a
+    stream that changes sample rate partway through, so that mkvmerge can handle it instead.
+    """
+    sync = b'\xff' if codec == 'aac' else b'\x0b\x77'
+    offsets = array('Q')
+    rate = spf = None
+    pos = last_end = 0
+    end = len(buf)
+    while pos + 7 <= end:
+        size = 0
+        if codec == 'aac':
+            if buf[pos] == 0xFF and buf[pos+1] & 0xF6 == 0xF0 and (buf[pos+2] >> 2) & 0x0F < 13:
+                size = ((buf[pos+3] & 0x03) << 11) | (buf[pos+4] << 3) | (buf[pos+5] >> 5)
+                frame_rate = _ADTS_RATES[(buf[pos+2] >> 2) & 0x0F]
+                frame_spf = 1024 * ((buf[pos+6] & 0x03) + 1)
+        elif buf[pos] == 0x0B and buf[pos+1] == 0x77:
+            if buf[pos+5] >> 3 > 10:
+                return None
+            fscod, frmsizecod = buf[pos+4] >> 6, buf[pos+4] & 0x3F
+            if fscod < 3 and frmsizecod < 38:
+                size = _AC3_WORDS[fscod][frmsizecod >> 1] * 2
+                if fscod == 1 and frmsizecod & 1:
+                    size += 2
+                frame_rate, frame_spf = _AC3_RATES[fscod], 1536
+        if size < 7:
+            pos = buf.find(sync, pos + 1)
+            if pos < 0:
+                break
+            continue
+        if pos + size > end:
+            break
+        if rate is None:
+            rate, spf = frame_rate, frame_spf
+        elif (rate, spf) != (frame_rate, frame_spf):
+            return None
+        offsets.append(pos)
+        pos = last_end = pos + size
+    if rate is None:
+        return None
+    offsets.append(last_end)
+    return offsets, rate, spf
+
+
+def _cache_dir():
+    """Where the on-disk caches live unless told otherwise."""
+    base = (os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'audiocutter')
+
+
+def _file_identity(path):
+    """A (path, size, mtime) triple that changes whenever the file does, or None if it's gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+_MKVMERGE_VERSIONS = {}
+# The name of the span currently open in this thread or task, to record as the parent of new ones
+_SPAN_PARENT = contextvars.ContextVar('audiocutter_span', default=None)
+_LOG = logging.getLogger('audiocutter')
+
+
+def _mkvmerge_version(mkvmerge):
+    """The first line of mkvmerge --version, or None if it won't run. Asked once per binary."""
+    from subprocess import check_output, CalledProcessError
+
+    if mkvmerge not in _MKVMERGE_VERSIONS:
+        try:
+            out = check_output([mkvmerge, '--version']).decode('utf-8', 'replace').strip()
+            _MKVMERGE_VERSIONS[mkvmerge] = out.splitlines()[0] if out else None
+        except (OSError, CalledProcessError):
+            _MKVMERGE_VERSIONS[mkvmerge] = None
+    return _MKVMERGE_VERSIONS[mkvmerge]
+
+
+def _child_cpu():
+    """CPU seconds used so far by finished child processes, like mkvmerge. Always 0 on windows."""
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def _mkvmerge_io(args):
+    """Bytes in the input and output files of a mkvmerge command line that has already run."""
+    outs = []
+    if '-o' in args:
+        out = args[args.index('-o') + 1]
+        outs = glob.glob(re.sub(r'%0?\d*d', '*', glob.escape(out))) if '%' in out else [out]
+    read = sum(getsize(a) for a in set(args) if a not in outs and os.path.isfile(a))
+    written = sum(getsize(o) for o in outs if os.path.isfile(o))
+    return {'bytes_read': read, 'bytes_written': written}
+
+
+def _fast_tmpdir(needed):
+    """A RAM backed folder with room for needed bytes (twice over) to put temp files in.
+
+    Returns None, meaning tempfile's usual spot, if there isn't one or TMPDIR has been set.
+    """
+    if 'TMPDIR' in os.environ or not hasattr(os, 'statvfs'):
+        return None
+    for folder in ('/dev/shm', os.environ.get('XDG_RUNTIME_DIR')):
+        try:
+            st = os.statvfs(folder)
+        except (TypeError, OSError):
+            continue
+        if os.access(folder, os.W_OK) and st.f_bavail * st.f_frsize > 2 * needed:
+            return folder
+    return None
+
+
+def _luma_array(frame):
+    """Copies the first plane of a vapoursynth frame into a float32 numpy array."""
+    import numpy as np
+
+    try:
+        plane = np.asarray(frame[0])
+    except TypeError:
+        # Older vapoursynth frames aren't subscriptable
+        plane = np.asarray(frame.get_read_array(0))
+    return plane.astype(np.float32)
+
+
+class JsonLinesSink(object):
+    """An Instrumentation sink that appends every span to path as a line of JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self.__lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class LoggingSink(object):
+    """An Instrumentation sink that logs every span, with the whole record as extra['span']."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """logger defaults to the "audiocutter" logger."""
+        self.logger = logger or _LOG
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, "%s: %.3fs wall, %.3fs cpu, %.3fs in child processes",
+                        record['name'], record['wall'], record['cpu'], record['child_cpu'],
+                        extra={'span': record})
+
+
+class Instrumentation(object):
+    """Times stages of work as spans, and hands each finished one to a sink.
+
+    sink can be any callable that takes the span's dict, the name of a file to append JSON lines
+    to (see JsonLinesSink), or a logging.Logger (see LoggingSink). Every span has name, parent
+    (the span it ran inside of, if any), start (a unix time), wall, cpu and child_cpu in
+    seconds, error if it ended with an exception, and whatever fields it was given, on top of
+    anything the code being timed adds, like mkvmerge's returncode and the bytes_read and
+    bytes_written of a step. cpu is for the whole process, so it includes other threads, and
+    child_cpu is what finished child processes like mkvmerge used.
+
+    Hand an instance to Timeline.instrumentation (or AudioCutter.instrumentation) to use it.
+    """
+
+    def __init__(self, sink, **fields):
+        """fields are added to every span, e.g. the episode when several are timed at once."""
+        if isinstance(sink, str):
+            sink = JsonLinesSink(sink)
+        elif isinstance(sink, logging.Logger):
+            sink = LoggingSink(sink)
+        self.sink = sink
+        self.fields = fields
+
+    def with_fields(self, **fields):
+        """Returns an Instrumentation with the same sink that adds fields to every span too."""
+        return Instrumentation(self.sink, **dict(self.fields, **fields))
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Times the with block as a span called name, yielding the dict that will be sent.
+
+        Anything added to the dict inside the block is sent along with the timings.
+        """
+        record = dict(self.fields, **fields)
+        record.update(name=name, parent=_SPAN_PARENT.get(), start=time.time())
+        token = _SPAN_PARENT.set(name)
+        wall, cpu, child_cpu = time.perf_counter(), time.process_time(), _child_cpu()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = str(e) or e.__class__.__name__
+            raise
+        finally:
+            _SPAN_PARENT.reset(token)
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['child_cpu'] = _child_cpu() - child_cpu
+            self.sink(record)
+
+
+class ProbeCache(object):
+    """An on-disk cache of mkvmerge --identify results and video_source audio lookups.
+
+    Entries are keyed by path, size and modification time, so a changed file is simply probed
+    again. Audio lookups for a video_source are kept as long as the video and the audio that was
+    found for it are unchanged, so if you add a new aac/ac3 that should win, invalidate() the
+    video (or just pass it as audio_source). Once there are
+    more than max_entries, the least recently used ones are dropped. Hand an instance to
+    Timeline.probe_cache (or AudioCutter.probe_cache) to use it.
+    """
+
+    def __init__(self, path=None, max_entries=1000):
+        """path defaults to probe.json in a per-user cache folder."""
+        self.path = path or os.path.join(_cache_dir(), 'probe.json')
+        self.max_entries = max_entries
+        self.__entries = None
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def identify(self, afile):
+        """Returns the stored probe results for afile, or None if it hasn't been seen as is."""
+        return self.__get(['identify', _file_identity(afile)])
+
+    def store_identify(self, afile, info):
+        """Stores the probe results for afile."""
+        ident = _file_identity(afile)
+        if ident is not None:
+            self.__put(['identify', ident], info, [ident[0]])
+
+    def audio_for(self, video_source):
+        """Returns the audio file previously found for video_source, if still valid."""
+        found = self.__get(['source', _file_identity(video_source)])
+        if found is None or _file_identity(found[0]) != found:
+            return None
+        return found[0]
+
+    def store_audio_for(self, video_source, afile):
+        """Stores the audio file that was found for video_source."""
+        video, found = _file_identity(video_source), _file_identity(afile)
+        if video is not None and found is not None:
+            self.__put(['source', video], found, [video[0], found[0]])
+
+    def invalidate(self, path=None):
+        """Forgets everything about path, which can be an audio or video file, or everything."""
+        with self.__lock:
+            entries = self.__load()
+            if path is None:
+                entries.clear()
+            else:
+                path = os.path.abspath(path)
+                for key in [k for k, v in entries.items() if path in v['paths']]:
+                    del entries[key]
+            self.__save()
+
+    def flush(self):
+        """Saves when entries were last used, if any were read since the last save.
+
+        Reading an entry doesn't write the file right away, so a run that only hits the cache
+        writes it once, when python exits, or whenever this is called.
+        """
+        with self.__lock:
+            if self.__dirty:
+                self.__save()
+
+    def __get(self, key):
+        if None in key:
+            return None
+        with self.__lock:
+            entry = self.__load().get(json.dumps(key))
+            if entry is None:
+                return None
+            # Saved by flush(), or runs that only ever hit would evict by when things were stored
+            entry['used'] = time.time()
+            self.__dirty = True
+            return entry['value']
+
+    def __put(self, key, value, paths):
+        with self.__lock:
+            entries = self.__load()
+            entries[json.dumps(key)] = {'used': time.time(), 'value': value, 'paths': paths}
+            if len(entries) > self.max_entries:
+                by_age = sorted(entries, key=lambda k: entries[k]['used'])
+                for k in by_age[:len(entries) - self.max_entries]:
+                    del entries[k]
+            self.__save()
+
+    def __load(self):
+        if self.__entries is None:
+            try:
+                with open(self.path) as f:
+                    self.__entries = json.load(f)
+            except (IOError, ValueError):
+                self.__entries = {}
+        return self.__entries
+
+    def __save(self):
+        # Write then rename, so a batch with several cutters never sees a half written file
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(self.__entries, f)
+        os.replace(tmp, self.path)
+        self.__dirty = False
+
+
+def _format_timecode(t, msp=False):
+    """Formats t seconds (ideally a Fraction) as HH:MM:SS.nnnnnnnnn, or HH:MM:SS.mmm with msp."""
+    return _format_ns(round(Fraction(t) * 10 ** 9), msp)
+
+
+def _format_ns(ns, msp=False):
+    """Formats ns nanoseconds as HH:MM:SS.nnnnnnnnn, or HH:MM:SS.mmm with msp.
+
+    All of it is integer arithmetic on the nanosecond count, so there's no float rounding to
+    worry about. Milliseconds round half up from there.
+    """
+    if msp:
+        s, ms = divmod((ns + 500000) // 10 ** 6, 1000)
+        frac = '{:03d}'.format(ms)
+    else:
+        s, ns = divmod(ns, 10 ** 9)
+        frac = '{:09d}'.format(ns)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return '{:02d}:{:02d}:{:02d}.{}'.format(h, m, s, frac)
+
+
+class TimestampIndex(object):
+    """Start times for every frame of a clip, constant framerate or not.
+
+    A constant framerate index is nothing but the framerate. A variable one keeps the start of
+    every frame as a running total of frame durations, stored as integers in a shared timebase
+    so they stay exact, which makes frame to time a lookup and time to frame a binary search.
+    Build variable ones with from_durations() or from_timecodes().
+    """
+
+    def __init__(self, fps_num=30000, fps_den=1001, starts=None, timebase=None):
+        """Either a constant fps_num/fps_den, or starts in units of 1/timebase seconds.
+
+        starts holds the start of every frame, followed by the end of the last one.
+        """
+        self.__fps = Fraction(fps_num, fps_den) if starts is None else None
+        self.__starts = starts
+        self.__timebase = timebase
+
+    @classmethod
+    def from_durations(cls, durations):
+        """Builds a variable framerate index from a duration (in seconds) for every frame.
+
+        The durations can be Fractions, or (numerator, denominator) pairs like vapoursynth's
+        _DurationNum/_DurationDen frame props.
+        """
+        durations = [Fraction(*d) if isinstance(d, tuple) else Fraction(d) for d in durations]
+        timebase = 1
+        for d in durations:
+            timebase = timebase * d.denominator // gcd(timebase, d.denominator)
+        starts = array('q', [0])
+        total = 0
+        for d in durations:
+            total += d.numerator * (timebase // d.denominator)
+            starts.append(total)
+        return cls(starts=starts, timebase=timebase)
+
+    @classmethod
+    def from_timecodes(cls, path):
+        """Reads a v2 timecodes file, like the ones mkvmerge and most source filters write.
+
+        Those only list when each frame starts, so the last frame is assumed to last as long
+        as the one before it.
+        """
+        with open(path) as f:
+            times = [Fraction(line.strip()) / 1000 for line in f
+                     if line.strip() and not line.startswith('#')]
+        if len(times) < 2:
+            raise ValueError("Need at least two frames in timecodes file: {}".format(path))
+        times.append(2 * times[-1] - times[-2])
+        timebase = 1
+        for t in times:
+            timebase = timebase * t.denominator // gcd(timebase, t.denominator)
+        return cls(starts=array('q', (int(t * timebase) for t in times)), timebase=timebase)
+
+    @property
+    def is_vfr(self):
+        """True if this index has a time for every frame, rather than a single framerate."""
+        return self.__starts is not None
+
+    @property
+    def num_frames(self):
+        """The number of frames covered, or None for a constant framerate."""
+        return len(self.__starts) - 1 if self.__starts is not None else None
+
+    def time(self, n):
+        """The start of frame n in seconds, as a Fraction. n can be num_frames for the end."""
+        if self.__starts is None:
+            return n / self.__fps
+        return Fraction(self.__starts[n], self.__timebase)
+
+    def frame(self, t):
+        """The number of the frame that is showing t seconds in."""
+        if self.__starts is None:
+            return int(Fraction(t) * self.__fps)
+        return bisect_right(self.__starts, int(Fraction(t) * self.__timebase)) - 1
+
+    def nanoseconds(self, n):
+        """The start of frame n in whole nanoseconds, rounded half to even like round().
+
+        Same as round(time(n) * 10 ** 9), but without building any Fractions, since this is
+        what every timecode goes through.
+        """
+        if self.__starts is None:
+            num, den = n * self.__fps.denominator * 10 ** 9, self.__fps.numerator
+        else:
+            num, den = self.__starts[n] * 10 ** 9, self.__timebase
+        ns, rem = divmod(num, den)
+        if 2 * rem > den or (2 * rem == den and ns % 2):
+            ns += 1
+        return ns
+
+    def timecode(self, n, msp=False):
+        """The start of frame n as HH:MM:SS.nnnnnnnnn, or HH:MM:SS.mmm if msp is True."""
+        return _format_ns(self.nanoseconds(n), msp)
+
+    def subset(self, trims):
+        """Returns the index of what's left after splicing together (start, end) trims."""
+        if self.__starts is None:
+            return self
+        starts = array('q', [0])
+        for trim in trims:
+            offset = starts[-1] - self.__starts[trim[0]]
+            starts.extend(x + offset for x in self.__starts[trim[0] + 1:trim[1] + 2])
+        return TimestampIndex(starts=starts, timebase=self.__timebase)
+
+    def write_timecodes(self, outfile, num_frames=None):
+        """Writes a v2 timecodes file, which mkvmerge can take with --timestamps.
+
+        num_frames is only needed for a constant framerate index.
+        """
+        if num_frames is None:
+            num_frames = self.num_frames
+        try:
+            with open(outfile, 'w') as o:
+                o.write('# timecode format v2\n')
+                for n in range(num_frames):
+                    us = round(self.time(n) * 10 ** 6)
+                    o.write('{}.{:03d}\n'.format(us // 1000, us % 1000))
+        except IOError:
+            print("Error writing to timecodes file: {}".format(outfile), file=sys.stderr)
+            raise
+
+
+class MetricCache(object):
+    """Frame difference and brightness numbers for scene detection, kept per source file.
+
+    Each source gets its own JSON file in path, named after the source's path, size and
+    modification time along with the frame size the numbers were measured at, so re-encoded
+    or replaced sources are simply measured again.
+    """
+
+    def __init__(self, path=None):
+        """path defaults to a metrics folder in the per-user cache folder."""
+        self.path = path or os.path.join(_cache_dir(), 'metrics')
+
+    def load(self, source, size):
+        """Returns the stored metrics for source, as measured at size, or empty ones."""
+        metrics = {'diff': {}, 'luma': {}, 'coarse': {}}
+        name = self.__file_for(source, size)
+        if name is None:
+            return metrics
+        try:
+            with open(name) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            return metrics
+        metrics['diff'] = {int(k): v for k, v in stored['diff'].items()}
+        metrics['luma'] = {int(k): v for k, v in stored['luma'].items()}
+        metrics['coarse'] = {int(k): {int(n): v for n, v in d.items()}
+                             for k, d in stored['coarse'].items()}
+        return metrics
+
+    def save(self, source, size, metrics):
+        """Stores metrics for source, replacing what was there."""
+        name = self.__file_for(source, size)
+        if name is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        stored = dict(metrics, source=os.path.abspath(source))
+        tmp = '{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp, name)
+
+    def invalidate(self, source=None):
+        """Forgets the metrics for source, or for every source."""
+        if not os.path.isdir(self.path):
+            return
+        source = os.path.abspath(source) if source is not None else None
+        for name in glob.glob(os.path.join(self.path, '*.json')):
+            if source is not None:
+                try:
+                    with open(name) as f:
+                        if json.load(f).get('source') != source:
+                            continue
+                except (IOError, ValueError):
+                    pass
+            os.remove(name)
+
+    def __file_for(self, source, size):
+        import hashlib
+
+        ident = _file_identity(source)
+        if ident is None:
+            return None
+        key = hashlib.sha1(json.dumps(ident + list(size)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+
+class ResultCache(object):
+    """Finished audio cuts, kept by everything that went into them, so unchanged episodes skip
+    cutting entirely.
+
+    The key is made from the audio's path, size and modification time, the trims, the source
+    framerate, the timecodes that are actually cut, the mkvmerge version and the cut options. A hit puts
+    the stored file at the output with a hardlink, or a copy where that won't work. Once the
+    stored files add up to more than max_bytes, the least recently used are removed. hits and
+    misses count lookups made through this instance. Hand an instance to
+    Timeline.result_cache (or AudioCutter.result_cache) to use it.
+    """
+
+    def __init__(self, path=None, max_bytes=2 * 1024 ** 3):
+        """path defaults to a results folder in the per-user cache folder."""
+        self.path = path or os.path.join(_cache_dir(), 'results')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """A dict of hits, misses, entries and bytes, the last two for everything stored."""
+        files = self.__files()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(files),
+                'bytes': sum(f[2] for f in files)}
+
+    def key(self, afile, trims, framerate, mkvmerge_version, options):
+        """Builds the key for cutting afile, or None if afile doesn't exist.
+
+        trims and options should be plain lists/dicts, as they go through json.
+        """
+        import hashlib
+
+        ident = _file_identity(afile)
+        if ident is None:
+            return None
+        blob = json.dumps([ident, trims, list(framerate), mkvmerge_version, options],
+                          sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def fetch(self, key, outfile):
+        """Puts the result stored under key at outfile. Returns False if there's nothing stored."""
+        stored = self.__file_for(key, outfile)
+        with self.__lock:
+            if not os.path.isfile(stored):
+                self.misses += 1
+                return False
+            self.hits += 1
+            os.utime(stored)
+        self.__place(stored, outfile)
+        return True
+
+    def store(self, key, outfile):
+        """Stores outfile under key, then trims the cache back down to max_bytes."""
+        if not os.path.isfile(outfile):
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self.__place(outfile, self.__file_for(key, outfile))
+        with self.__lock:
+            files = sorted(self.__files(), key=lambda f: f[1])
+            total = sum(f[2] for f in files)
+            for name, _, size in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(name)
+                except OSError:
+                    continue
+                total -= size
+
+    def detach(self, outfile):
+        """Removes outfile if it's a hardlink, before something overwrites it.
+
+        Writing into a hardlinked file in place would change the stored copy too. cut_audio()
+        does this for you.
+        """
+        try:
+            if os.stat(outfile).st_nlink > 1:
+                os.remove(outfile)
+        except OSError:
+            pass
+
+    def invalidate(self):
+        """Removes every stored result.
+
+        Results for audio that has changed are never used anyway, so this is only needed to
+        free up the space.
+        """
+        with self.__lock:
+            for name, _, _ in self.__files():
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+    def __file_for(self, key, outfile):
+        return os.path.join(self.path, key + splitext(outfile)[1].lower())
+
+    def __files(self):
+        """(name, last used, size) for every stored result."""
+        files = []
+        if not os.path.isdir(self.path):
+            return files
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                st = entry.stat()
+                files.append((entry.path, st.st_mtime, st.st_size))
+        return files
+
+    def __place(self, src, dst):
+        # Link (or copy) to a temp name first, so dst is never seen half written. Renaming over
+        # another link to the same file does nothing at all, so that case is skipped outright.
+        from shutil import copyfile
+
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        tmp = '{}.{}.{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class _TrimArray(object):
+    """Trims held as arrays of start and (inclusive) end frames, rather than a list of tuples.
+
+    Thousands of trims from commercial detection take a fraction of the memory this way, and
+    iterating still gives (start, end) tuples, so it reads just like the list it replaced.
+    """
+
+    def __init__(self, starts=None, ends=None):
+        self.starts = array('q') if starts is None else starts
+        self.ends = array('q') if ends is None else ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def lengths(self):
+        """The number of frames in each trim."""
+        return [e - s + 1 for s, e in zip(self.starts, self.ends)]
+
+
+class Timeline(object):
+    """Trims, audio cuts, qpfiles and chapters from nothing but frame counts and framerates.
+
+    This is everything AudioCutter does that doesn't actually need to look at video, so it can
+    run on machines without vapoursynth, or without waiting on a source filter to index a huge
+    transport stream just to learn its frame count. AudioCutter is built on top of it.
+    """
+
+    def __init__(self, trims=None, num_frames=None, fps_num=30000, fps_den=1001):
+        """Optionally takes the same trims split() does, along with the source's framerate.
+
+        num_frames is the length of the source, and is only needed if any of the trims use 0
+        as the end frame to mean "until the end". If trims are given, they are validated and the
+        audio cut is prepared right away, the same way split() would, and bad trims will raise
+        ValueError. Otherwise use set_trims() and prepare_cut() yourself.
+        """
+        self.__mkvmerge = MKVMERGE
+        self.__trim_holder = _TrimArray()
+        self.__is_ordered = True
+        self.__fps_num = fps_num
+        self.__fps_den = fps_den
+        self.__cut_cmd = ''
+        self.__ch_frames = None
+        self.__ch_names = []
+        self.__ch_count = 0
+        self.chapter_names = []
+        self.probe_cache = None
+        self.result_cache = None
+        self.instrumentation = None
+        self.__timestamps = None
+        self.__cfr = None
+        self.__cut_timestamps = None
+        self.__cut_framerate = (fps_num, fps_den)
+        self.__out_timestamps = None
+        self.__out_frames = None
+        if trims is not None:
+            valid, msg = self.set_trims(trims, num_frames)
+            if not valid:
+                raise ValueError(msg)
+            self.prepare_cut()
+
+    def span(self, name, **fields):
+        """Times a stage of work as a span sent to instrumentation, see Instrumentation.span().
+
+        Use it in a with statement. It does nothing if instrumentation is None. This is handy for
+        timing your own stages next to AudioCutter's, e.g. opening the source:
+            with ac.span('source', file='01.ts'):
+                vid = core.lsmas.LWLibavSource('01.ts')
+        """
+        if self.instrumentation is None:
+            return nullcontext({})
+        return self.instrumentation.span(name, **fields)
+
+    @property
+    def chapters(self):
+        """A string containing the lines for a chapter file."""
+        return ''.join(self.iter_chapter_lines())
+
+    @property
+    def chapter_names(self):
+        """A list of strings to be used in the chapter output."""
+        return self.__chapter_names
+
+    @chapter_names.setter
+    def chapter_names(self, names):
+        self.__chapter_names = names
+
+    @property
+    def cut_cmd(self):
+        """The mkvmerge command(s) that will be called, to show the timecodes.
+
+        Do note that the actual cutting method modifies this further, though not
+        the timecodes. If you just want to ensure that it's cutting in the right
+        spot, this is fine after cut_audio()
+
+        Note that this command will come with two format string variables,
+        {0} for the input filename, and {1} for the output. Out of order cuts also
+        use {3} for the temp directory holding the pieces. cut_audio() handles
+        this for you though.
+        """
+        return self.__cut_cmd
+
+    @property
+    def qp_lines(self):
+        """Returns the lines that would be output to a qpfile."""
+        return ''.join(self.iter_qp_lines())
+
+    def iter_qp_lines(self):
+        """Yields the lines of qp_lines one at a time, without building the whole string."""
+        if self.__ch_frames is None:
+            return
+        for frame in self.__ch_frames[1:]:
+            yield '{} K\n'.format(frame)
+
+    def iter_chapter_lines(self):
+        """Yields the lines of chapters one at a time, without building the whole string."""
+        if self.__ch_frames is None:
+            return
+        index = self.__out_timestamps
+        names = self.__ch_names
+        for i, frame in enumerate(self.__ch_frames, 1):
+            yield "CHAPTER{0:02d}={1}\n".format(i, index.timecode(frame, True))
+            if i <= len(names) and names[i-1]:
+                yield "CHAPTER{0:02d}NAME={1}\n".format(i, names[i-1])
+            else:
+                yield "CHAPTER{0:02d}NAME=Chapter {0:02d}\n".format(i)
+
+    def iter_xml_chapter_lines(self, language='eng', ordered=False, links=None, uid_seed=None):
+        """Yields the lines of a Matroska XML chapter file, see write_xml_chapters()."""
+        if self.__ch_frames is None:
+            return
+        index = self.__out_timestamps
+        names = self.__ch_names
+        rng = random.Random(uid_seed)
+        links = dict(links or {})
+        ordered = ordered or bool(links)
+
+        # One chapter per segment, each ending where the next starts, and the last one at the
+        # end of the video. Linked chapters are slotted in before the chapter they're keyed on.
+        bounds = [index.nanoseconds(x) for x in self.__ch_frames[:self.__ch_count]]
+        bounds.append(index.nanoseconds(self.__out_frames))
+        chapters = []
+        for i in range(self.__ch_count + 1):
+            if i in links:
+                chapters.append(self.__linked_chapter(links.pop(i)))
+            if i < self.__ch_count:
+                name = names[i] if i < len(names) and names[i] else "Chapter {:02d}".format(i + 1)
+                chapters.append((bounds[i], bounds[i + 1], None, name))
+        if links:
+            raise ValueError("Linked chapters can only go before chapters 0 to {}, not {}".format(
+                self.__ch_count, sorted(links)))
+
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<!DOCTYPE Chapters SYSTEM "matroskachapters.dtd">\n'
+        yield '<Chapters>\n'
+        yield '  <EditionEntry>\n'
+        yield '    <EditionUID>{}</EditionUID>\n'.format(rng.getrandbits(64) or 1)
+        yield '    <EditionFlagDefault>1</EditionFlagDefault>\n'
+        yield '    <EditionFlagOrdered>{:d}</EditionFlagOrdered>\n'.format(ordered)
+        for start, end, segment_uid, name in chapters:
+            yield '    <ChapterAtom>\n'
+            yield '      <ChapterUID>{}</ChapterUID>\n'.format(rng.getrandbits(64) or 1)
+            yield '      <ChapterTimeStart>{}</ChapterTimeStart>\n'.format(_format_ns(start))
+            yield '      <ChapterTimeEnd>{}</ChapterTimeEnd>\n'.format(_format_ns(end))
+            if segment_uid:
+                yield '      <ChapterSegmentUID format="hex">{}</ChapterSegmentUID>\n'.format(
+                    segment_uid)
+            yield '      <ChapterDisplay>\n'
+            yield '        <ChapterString>{}</ChapterString>\n'.format(escape(name))
+            yield '        <ChapterLanguage>{}</ChapterLanguage>\n'.format(escape(language))
+            yield '      </ChapterDisplay>\n'
+            yield '    </ChapterAtom>\n'
+        yield '  </EditionEntry>\n'
+        yield '</Chapters>\n'
+
+    def iter_split_parts(self):
+        """Yields the (start, end) timecodes of every piece of audio the cut splits out.
+
+        When the trims are in order, adjacent trims come out as a single piece, just like
+        cut_audio() cuts them. Otherwise, these are the pieces of the source the trims are made
+        of, in source order, which cut_audio() then appends in trim order. The times are those
+        of the source as of prepare_cut(), so ready_qp_and_chapters() changing the framerate
+        doesn't move them, just like it doesn't move the cut itself.
+        """
+        if self.__check_ordered():
+            pieces = ((trim[0], trim[1] + 1) for trim in self.__merge_adjacent())
+        else:
+            pieces = self.__unordered_pieces()[0]
+        for start, end in pieces:
+            yield self.__frame_to_timecode(start), self.__frame_to_timecode(end)
+
+    def iter_audio_ranges(self, sample_rate, delay_ms=None):
+        """Yields the (start, end) sample numbers of the audio the trims keep, in trim order.
+
+        These are exact, instead of rounded to the frames of a lossy codec like cut_audio() has
+        to, since AudioCutter.split() cuts vapoursynth audio with them. Trims that are back to
+        back come out as a single range. A positive delay_ms means the audio starts that much
+        later than the video, so a start can be negative where silence has to be added, and an
+        end can be past the end of the audio the same way. Like iter_split_parts(), this uses the
+        source's frame times as of prepare_cut().
+        """
+        index = self.__source_timestamps()
+        delay = Fraction(delay_ms or 0, 1000)
+        last = None
+        for trim in self.__trim_holder:
+            start = round((index.time(trim[0]) - delay) * sample_rate)
+            end = round((index.time(trim[1] + 1) - delay) * sample_rate)
+            if last is not None and last[1] == start:
+                last = (last[0], end)
+                continue
+            if last is not None:
+                yield last
+            last = (start, end)
+        if last is not None:
+            yield last
+
+    def find_audio(self, video_source=None, audio_source=None):
+        """Returns the audio file cut_audio() would cut, and the DELAY in its name (None if none).
+
+        video_source and audio_source mean the same as they do for cut_audio(). Raises
+        AudioCutterError if there's no audio to be found.
+        """
+        return self.__cut_source(video_source, audio_source)
+
+    @property
+    def trims(self):
+        """The validated (start, end) pairs, with end frames inclusive and 0 ends resolved."""
+        return list(self.__trim_holder)
+
+    @property
+    def framerate(self):
+        """The (fps_num, fps_den) pair that frame numbers are currently converted with."""
+        return self.__fps_num, self.__fps_den
+
+    def set_framerate(self, fps_num, fps_den):
+        """Changes the framerate used to turn frame numbers into timecodes."""
+        self.__fps_num = fps_num
+        self.__fps_den = fps_den
+
+    @property
+    def timestamps(self):
+        """The TimestampIndex that source frame numbers are turned into times with.
+
+        Unless set_timestamps() was used, this is just the constant source framerate.
+        """
+        if self.__timestamps is not None:
+            return self.__timestamps
+        if self.__cfr is None or self.__cfr[0] != (self.__fps_num, self.__fps_den):
+            self.__cfr = ((self.__fps_num, self.__fps_den),
+                          TimestampIndex(self.__fps_num, self.__fps_den))
+        return self.__cfr[1]
+
+    def set_timestamps(self, index):
+        """Uses a TimestampIndex for the source frame times, e.g. for variable framerate sources.
+
+        This has to happen before split()/prepare_cut() for the audio cut to use it. Chapters
+        follow it as long as the framerate isn't changed afterwards, and write_timecodes() will
+        write the matching timecodes for the trimmed video. Set to None to go back to the
+        constant framerate.
+        """
+        self.__timestamps = index
+
+    def read_timecodes(self, path):
+        """Reads the source frame times from a v2 timecodes file, see set_timestamps()."""
+        self.set_timestamps(TimestampIndex.from_timecodes(path))
+
+    def write_timecodes(self, outfile):
+        """Writes v2 timecodes for the trimmed video, to mux with mkvmerge --timestamps.
+
+        This agrees with the chapters and audio cut, and is mostly useful for variable framerate
+        sources. Before ready_qp_and_chapters() it assumes the framerate didn't change.
+        """
+        with self.span('write_timecodes'):
+            index, frames = self.__out_timestamps, self.__out_frames
+            if index is None:
+                index = self.timestamps.subset(self.__trim_holder)
+                frames = sum(self.__trim_holder.lengths())
+            index.write_timecodes(outfile, frames)
+
+    def set_trims(self, trims, num_frames=None):
+        """Validates and stores a list of trims in the same format split() takes.
+
+        Returns a (valid, message) pair rather than raising, so AudioCutter can write the
+        message onto the video. Chapter names given as third members of the trims replace
+        chapter_names, exactly like split().
+
+        Everything is checked in a single pass, which also works out whether the trims are in
+        order, and the message says which trim (counting from 0) is the problem, which helps
+        a lot with thousands of generated ones. Each trim needs two integers (any subclass of
+        numbers.Integral will do), the start no more than the end and neither negative, and
+        anything after the chapter name is ignored. Nothing is changed if they're invalid.
+        """
+        if (not isinstance(trims, (list, tuple))):
+            return False, "Did not pass a list of lists/tuples to split()"
+        starts, ends, names = array('q'), array('q'), []
+        ordered = True
+        for i, trim in enumerate(trims):
+            if (not isinstance(trim, (list, tuple))):
+                return False, "Trim {} is not a list/tuple".format(i)
+            if (len(trim) < 2 or not (isinstance(trim[0], numbers.Integral) and
+                                      isinstance(trim[1], numbers.Integral))):
+                return False, "Trim {} is not a group of two integers".format(i)
+            start, end = int(trim[0]), int(trim[1])
+            if end <= 0:
+                if num_frames is None:
+                    return False, ("Trim {} ends at frame {}, which needs the source length to "
+                                   "be known".format(i, end))
+                end = num_frames - 1
+            if ((end < start) or (start < 0)):
+                return False, "Trim {} ({}, {}) is either out of order, or negative".format(
+                    i, start, end)
+            if ends and ends[-1] > start:
+                ordered = False
+            starts.append(start)
+            ends.append(end)
+            names.append(trim[2] if len(trim) > 2 else None)
+
+        self.__trim_holder = _TrimArray(starts, ends)
+        self.__is_ordered = ordered
+        self.chapter_names = names
+        return True, ""
+
+    def prepare_cut(self, fps_num=None, fps_den=None):
+        """Builds cut_cmd from the stored trims, optionally setting the source framerate first."""
+        with self.span('prepare_cut', trims=len(self.__trim_holder)):
+            if fps_num is not None:
+                self.set_framerate(fps_num, fps_den)
+            # ready_qp_and_chapters() moves the framerate on to the final one, but the audio is
+            # always cut in source frames
+            self.__cut_timestamps = self.timestamps
+            self.__cut_framerate = self.framerate
+            self.__prepare_audio_cut_lines()
+
+    def cut_audio(self, outfile, video_source=None, audio_source=None, aac_is_sbr=False,
+                  native=True):
+        """Cuts the supplied audio file, based on trims from AudioCutter.split() or set_trims()
+
+        video_source is intended for use with a video type where you've either manually
+        demuxed an audio track to the same name as your source (e.g. tsmuxer + LSMASHSource),
+        or generated an index file that demuxes the audio in a very similar way
+        (e.g dgindex + d2v.Source). It will search for filenames that begin with the video name,
+        but have an aac or ac3 extension, as these are the most likely output from those types
+        of sources (DVDs/Transport streams). It always uses the largest available file, so don't
+        use this option if for some reason you have ac3 and aac files that are similar to your
+        source name, unless you're sure you want the ac3, as it will be bigger. This is mutually
+        exclusive with audio_source.
+
+        audio_source simply takes an audio file name, in case your audio isn't so strictly named
+        like your video. This is mutually exclusive with video_source.
+        
+        aac_is_sbr should be set to true if your audio file is an he-aac file that is using spectral
+        band replication sbr. Older versions of audiocutter and its predecessor split_aud.pl checked
+        automatically using mkvmerge's --identify-for-mmg, but that is gone and the replacement is 
+        much too complex for auto-setting a single boolean that is almost never True. If you don't know
+        if your aac is a low bitrate HE-AAC/AAC+ with SBR, it probably isn't.
+
+        Out of order trims take two mkvmerge calls. The first reads the source once and splits
+        out every piece any trim needs (overlapping trims are cut where they overlap, so the
+        shared bits are only cut once), and the second appends those pieces in trim order.
+        mkvmerge always gets its arguments from a JSON option file, so thousands of trims don't
+        overflow the command line. The pieces go to a freshly made temp directory, in RAM (/dev/shm) if
+        there's room and TMPDIR isn't set, that is removed afterwards, so several cuts can run
+        side by side in the same folder without clobbering each other.
+
+        If the audio is a raw aac (ADTS) or ac3 file and outfile has the same extension, it is
+        cut right here by copying whole audio frames, without running mkvmerge at all. Any
+        DELAY in the file name is applied, and out of order trims work just the same. Audio that
+        can't be handled that way (E-AC3, a delay that would need silence added at the start, or
+        an outfile in some other format) still goes through mkvmerge. Set native to False to
+        always use mkvmerge.
+
+        outfile should be fairly straightforward.
+
+        This blocks until mkvmerge is done, and exits the script if anything goes wrong. See
+        cut_audio_async() and start_cut_audio() for a version that does neither.
+        """
+        with self.span('cut_audio', outfile=outfile):
+            from subprocess import call
+            from tempfile import TemporaryDirectory
+
+            try:
+                afile, delay_ms = self.__cut_source(video_source, audio_source)
+            except AudioCutterError as e:
+                exit(str(e))
+
+            key = self.__result_key(afile, outfile, aac_is_sbr, native)
+            if key is not None:
+                with self.span('result_cache') as stage:
+                    stage['hit'] = self.result_cache.fetch(key, outfile)
+                if stage['hit']:
+                    return
+                self.result_cache.detach(outfile)
+
+            if (native and splitext(afile)[1].lower() == splitext(outfile)[1].lower() and
+                    self.__cut_raw(afile, outfile, delay_ms or 0)):
+                if key is not None:
+                    self.result_cache.store(key, outfile)
+                return
+
+            tid = self.__identify(afile)['track_id']
+
+            with TemporaryDirectory(prefix='audiocutter-', dir=self.__tmpdir_for(afile)) as tmpdir:
+                for i, cmd in enumerate(self.__cut_lines(afile, outfile, delay_ms, tid, aac_is_sbr,
+                                                         tmpdir)):
+                    _LOG.debug("mkvmerge step %d: %s", i, cmd)
+                    args, options = self.__write_options(cmd, tmpdir, i)
+                    with self.span('mkvmerge', step=i, cmd=cmd) as stage:
+                        cutExec = call([args[0], '@' + options])
+                        stage['returncode'] = cutExec
+                        stage.update(_mkvmerge_io(args))
+                    if cutExec == 2:
+                        print(args)
+                        exit("Failed to execute mkvmerge: {0:d}".format(cutExec))
+
+            if cutExec == 1:
+                print("Mkvmerge exited with warnings: {0:d}".format(cutExec))
+            if key is not None:
+                self.result_cache.store(key, outfile)
+
+    async def cut_audio_async(self, outfile, video_source=None, audio_source=None,
+                              aac_is_sbr=False, native=True, progress=None, timeout=None):
+        """Cuts audio just like cut_audio(), as a coroutine that doesn't block the event loop.
+
+        That way the cut can run alongside anything else in the same loop, like vspipe feeding
+        an encoder. mkvmerge runs as an asyncio subprocess, and anything else that would block
+        (probing the audio, a native cut) is done in the loop's default executor.
+
+        progress is called with how far along the whole cut is, from 0 to 100, each time
+        mkvmerge reports progress. timeout is in seconds and covers the whole cut, probing
+        included, and raises asyncio.TimeoutError when it runs out. Cancelling the task or
+        running out of time kills mkvmerge and cleans up the temp files. A probe or native cut
+        that's already running in the executor can't be stopped, so it finishes in the
+        background even though the coroutine has given up on it.
+
+        Rather than exiting, this raises AudioCutterError if there's no audio to cut, or
+        MkvmergeError if mkvmerge fails. Returns mkvmerge's exit code, which is 1 if it had
+        warnings and 0 otherwise.
+        """
+        import asyncio
+
+        with self.span('cut_audio', outfile=outfile):
+            return await asyncio.wait_for(self.__cut_audio_async(outfile, video_source,
+                                                                 audio_source, aac_is_sbr,
+                                                                 native, progress), timeout)
+
+    async def __cut_audio_async(self, outfile, video_source, audio_source, aac_is_sbr, native,
+                                progress):
+        """Does the work of cut_audio_async(), which bounds all of it by the timeout."""
+        import asyncio
+        from subprocess import CalledProcessError
+        from tempfile import TemporaryDirectory
+
+        loop = asyncio.get_running_loop()
+        afile, delay_ms = await loop.run_in_executor(None, self.__cut_source, video_source,
+                                                     audio_source)
+
+        key = await loop.run_in_executor(None, self.__result_key, afile, outfile, aac_is_sbr,
+                                         native)
+        if key is not None:
+            with self.span('result_cache') as stage:
+                stage['hit'] = await loop.run_in_executor(None, self.result_cache.fetch, key,
+                                                          outfile)
+            if stage['hit']:
+                if progress is not None:
+                    progress(100)
+                return 0
+            await loop.run_in_executor(None, self.result_cache.detach, outfile)
+
+        if (native and splitext(afile)[1].lower() == splitext(outfile)[1].lower() and
+                await loop.run_in_executor(None, contextvars.copy_context().run,
+                                           self.__cut_raw, afile, outfile, delay_ms or 0)):
+            if key is not None:
+                await loop.run_in_executor(None, self.result_cache.store, key, outfile)
+            if progress is not None:
+                progress(100)
+            return 0
+
+        try:
+            tid = (await loop.run_in_executor(None, contextvars.copy_context().run,
+                                                 self.__identify, afile))['track_id']
+        except CalledProcessError as e:
+            raise MkvmergeError(e.cmd, e.returncode, (e.output or b'').decode('utf-8', 'replace'))
+        except OSError as e:
+            raise MkvmergeError([self.__mkvmerge], 2, str(e))
+
+        folder = await loop.run_in_executor(None, self.__tmpdir_for, afile)
+        with TemporaryDirectory(prefix='audiocutter-', dir=folder) as tmpdir:
+            lines = self.__cut_lines(afile, outfile, delay_ms, tid, aac_is_sbr, tmpdir)
+            returncode = await self.__run_cut_async(lines, tmpdir, progress)
+        if key is not None:
+            await loop.run_in_executor(None, self.result_cache.store, key, outfile)
+        return returncode
+
+    def start_cut_audio(self, outfile, video_source=None, audio_source=None, aac_is_sbr=False,
+                        native=True, progress=None, timeout=None):
+        """Starts cut_audio_async() in a background thread, and returns right away.
+
+        For scripts that don't have an event loop of their own. The return value is a
+        concurrent.futures.Future, so result() waits for the cut (raising whatever
+        cut_audio_async() would), done() checks on it and cancel() stops it. progress is called
+        from the background thread.
+        """
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+
+        async def shutdown():
+            # A cancelled cut still has to kill mkvmerge and clean up before the loop can stop
+            others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            await asyncio.gather(*others, return_exceptions=True)
+            loop.stop()
+
+        def serve():
+            try:
+                loop.run_forever()
+            finally:
+                loop.close()
+
+        future = asyncio.run_coroutine_threadsafe(
+            self.cut_audio_async(outfile, video_source, audio_source, aac_is_sbr, native, progress,
+                                 timeout), loop)
+        # This runs even if the future is cancelled before the cut ever starts
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(loop.create_task, shutdown()))
+        threading.Thread(target=serve, name='audiocutter-cut', daemon=True).start()
+        return future
+
+    def ready_qp_and_chapters(self, fps_num=None, fps_den=None, segment_frames=None):
+        """Populates qp_lines and chapters from the stored trims, without any video.
+
+        fps_num/fps_den is the final framerate, defaulting to the source framerate, and works
+        just like the framerate of the clip passed to AudioCutter.ready_qp_and_chapters().
+        segment_frames can be a list with the length of every segment, in case they've been
+        changed by per-segment processing (set_framerate() to the new rate in that case, like
+        join(update_framerate=True) does). Otherwise, the trim lengths are used.
+        """
+        with self.span('ready_qp_and_chapters', trims=len(self.__trim_holder)):
+            if fps_num is None:
+                fps_num, fps_den = self.__fps_num, self.__fps_den
+            trim_frames = self.__trim_holder.lengths()
+            segment_frames = trim_frames if segment_frames is None else list(segment_frames)
+
+            # Calculate the scalar value for fps change first. Variable framerate clips report a
+            # framerate of 0, and there's no scaling those anyway.
+            if fps_num and self.__fps_num:
+                inverse_source_fps = Fraction(self.__fps_den, self.__fps_num)
+                current_fps = Fraction(fps_num, fps_den)
+                scalar = inverse_source_fps * current_fps
+
+                # Now update it for the chapter timecodes
+                self.__fps_num = current_fps.numerator
+                self.__fps_den = current_fps.denominator
+            else:
+                scalar = 1
+
+            # Variable framerate sources can only be followed if the frames are the trimmed ones
+            if (self.__timestamps is not None and scalar == 1 and
+                    segment_frames == trim_frames):
+                index = self.__timestamps.subset(self.__trim_holder)
+            else:
+                index = self.timestamps if self.__timestamps is None else TimestampIndex(
+                    self.__fps_num, self.__fps_den)
+            self.__out_timestamps = index
+            self.__out_frames = int(sum(x * scalar for x in segment_frames))
+
+            # Every segment after the first starts a chapter, at the running total of the scaled
+            # lengths. A lone segment still gets a second chapter where it ends, as it always has.
+            ch_frames = array('q', [0])
+            total = 0
+            for frames in segment_frames[:-1] or segment_frames[:1]:
+                total += frames * scalar
+                ch_frames.append(int(total))
+            self.__ch_frames = ch_frames
+            self.__ch_names = list(self.chapter_names)
+            self.__ch_count = len(segment_frames)
+
+    def write_qpfile(self, outfile):
+        """Writes qp_lines to outfile.
+
+        Obviously, this is of limited use if you have not run ready_qp_and_chapters(),
+        as the default is an empty string, but that operation should succeed.
+        """
+        with self.span('write_qpfile') as stage:
+            try:
+                with open(outfile, 'w') as o:
+                    o.writelines(self.iter_qp_lines())
+            except IOError:
+                print("Error writing to qpfile: {}".format(outfile), file=sys.stderr)
+                raise
+            stage['bytes_written'] = getsize(outfile)
+
+    def write_chapters(self, outfile):
+        """Writes chapters to outfile.
+
+        Obviously, this is of limited use if you have not run ready_qp_and_chapters(),
+        as the default is an empty string, but that operation should succeed.
+        """
+        with self.span('write_chapters') as stage:
+            try:
+                with open(outfile, 'w') as o:
+                    o.writelines(self.iter_chapter_lines())
+            except IOError:
+                print("Error writing to chapter file: {}".format(outfile), file=sys.stderr)
+                raise
+            stage['bytes_written'] = getsize(outfile)
+
+    def write_xml_chapters(self, outfile, language='eng', ordered=False, links=None,
+                           uid_seed=None):
+        """Writes Matroska XML chapters to outfile, for mkvmerge --chapters.
+
+        These are the same chapters as write_chapters(), but with nanosecond times, an end
+        time for every chapter, and language as the ChapterLanguage. If ordered is True, the
+        edition is written as ordered chapters.
+
+        links makes an ordered edition that pulls in other files, like an OP or ED that is the
+        same every episode and only needs encoding once. It maps a chapter position to a
+        (segment_uid, duration[, name]) tuple, and that file's segment (its SegmentUID as hex,
+        like mkvinfo shows it) is played from the start for duration seconds before the chapter
+        at that position. Position 0 is before the first chapter, and the number of chapters is
+        after the last one.
+
+        UIDs are random unless uid_seed is given, which makes the output repeatable.
+        """
+        with self.span('write_xml_chapters') as stage:
+            try:
+                with open(outfile, 'w', encoding='utf-8') as o:
+                    o.writelines(self.iter_xml_chapter_lines(language, ordered, links, uid_seed))
+            except IOError:
+                print("Error writing to chapter file: {}".format(outfile), file=sys.stderr)
+                raise
+            stage['bytes_written'] = getsize(outfile)
+
+    def __linked_chapter(self, link):
+        """Turns a (segment_uid, duration[, name]) link into a (start, end, uid, name) chapter."""
+        segment_uid = re.sub(r'0x|\s', '', link[0])
+        if not re.match(r'^[0-9a-fA-F]{32}$', segment_uid):
+            raise ValueError("Not a 128 bit hex segment UID: {}".format(link[0]))
+        name = link[2] if len(link) > 2 and link[2] else "Linked"
+        return 0, round(Fraction(link[1]) * 10 ** 9), segment_uid.lower(), name
+
+    def __cut_source(self, video_source, audio_source):
+        """Finds the audio cut_audio() should cut, and the DELAY in its name (None if there's none).
+
+        Raises AudioCutterError if there's no audio to be found, or it isn't there.
+        """
+        if video_source is None and audio_source is None:
+            raise AudioCutterError("You didn't supply any audio to cut")
+        elif (video_source is not None) and (audio_source is not None):
+            raise AudioCutterError("Please supply only one of video_source or audio_source")
+        elif video_source is None:
+            afile = audio_source
+        else:
+            afile = self.__find_audio(video_source)
+        if not os.path.isfile(afile):
+            raise AudioCutterError("Can't find the audio to cut: {}".format(afile))
+
+        delay_ms = _DELAY_RE.search(afile)
+        return afile, int(delay_ms.group(1)) if delay_ms else None
+
+    def __result_key(self, afile, outfile, aac_is_sbr, native):
+        """The result_cache key for cutting afile to outfile, or None if there's no cache."""
+        if self.result_cache is None:
+            return None
+        # cut_cmd and the framerate saved with it stay in source time, while self.framerate
+        # moves on to the final one in ready_qp_and_chapters()
+        options = {'aac_is_sbr': bool(aac_is_sbr), 'native': bool(native),
+                   'format': splitext(outfile)[1].lower(), 'cut': self.__cut_cmd}
+        return self.result_cache.key(afile, [list(x) for x in self.__trim_holder],
+                                     self.__cut_framerate, _mkvmerge_version(self.__mkvmerge),
+                                     options)
+
+    def __tmpdir_for(self, afile):
+        """Where the temp folder for cutting afile goes. See _fast_tmpdir()."""
+        return None if self.__is_ordered else _fast_tmpdir(getsize(afile))
+
+    def __cut_lines(self, afile, outfile, delay_ms, tid, aac_is_sbr, tmpdir):
+        """Fills in cut_cmd for afile and outfile, returning the mkvmerge command lines to run."""
+        if afile.endswith('aac') and aac_is_sbr:
+            sbr = "0:1"
+        else:
+            sbr = None
+
+        delay = '{0}:{1}'.format(tid, delay_ms) if delay_ms is not None else None
+
+        final_cut = self.__cut_cmd
+        if delay:
+            delay_statement = " --sync {}".format(delay)
+        else:
+            delay_statement = ''
+        sbr_statement = " --aac-is-sbr {}".format(sbr) if sbr else ''
+
+        if self.__is_ordered:
+            final_cut += sbr_statement + ' -o {1} "{0}"'
+            return [final_cut.format(afile, outfile, delay_statement)]
+        # shlex eats backslashes, and mkvmerge is perfectly happy with forward slashes
+        return final_cut.format(afile, outfile, delay_statement + sbr_statement,
+                                tmpdir.replace('\\', '/')).split('\n')
+
+    def __write_options(self, cmd, folder, step):
+        """Writes one line of cut_cmd to a mkvmerge JSON option file in folder.
+
+        mkvmerge takes that as @file, so thousands of trims never hit the command line length
+        limit. Returns the arguments and the option file's name.
+        """
+        args = shlex.split(cmd)
+        options = os.path.join(folder, 'options-{}.json'.format(step))
+        with open(options, 'w', encoding='utf-8') as f:
+            json.dump(args[1:], f)
+        return args, options
+
+    async def __run_cut_async(self, lines, tmpdir, progress):
+        """Runs the cut_cmd lines one after the other for cut_audio_async()."""
+        import asyncio
+        from subprocess import PIPE, STDOUT
 
-    def __init__(self):
-        """Bog standard initialization. There are no possible arguments."""
+        returncode = 0
+        for step, cmd in enumerate(lines):
+            _LOG.debug("mkvmerge step %d: %s", step, cmd)
+            args, options = self.__write_options(cmd, tmpdir, step)
+            with self.span('mkvmerge', step=step, cmd=cmd) as stage:
+                try:
+                    proc = await asyncio.create_subprocess_exec(args[0], '@' + options,
+                                                                stdout=PIPE, stderr=STDOUT)
+                except OSError as e:
+                    raise MkvmergeError(args, 2, str(e))
+                output = []
+                try:
+                    pending = b''
+                    while True:
+                        chunk = await proc.stdout.read(4096)
+                        if not chunk:
+                            break
+                        # Progress is redrawn with carriage returns, so split on those too
+                        *done, pending = re.split(rb'[\r\n]', pending + chunk)
+                        for line in done:
+                            percent = _PROGRESS_RE.search(line)
+                            if percent and progress is not None:
+                                progress((step * 100 + int(percent.group(1))) / len(lines))
+                            elif line.strip() and not percent:
+                                output.append(line.decode('utf-8', 'replace'))
+                    code = await proc.wait()
+                except BaseException:
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                    raise
+                stage['returncode'] = code
+                stage.update(_mkvmerge_io(args))
+            if code >= 2:
+                raise MkvmergeError(args, code, '\n'.join(output))
+            returncode = max(returncode, code)
+        return returncode
 
-        # Easy, top of file spot for mkvmerge path. If the binary isn't in your PATH, edit
-        # it here.
-        self.__mkvmerge = r'C:/Program Files/MKVtoolnix/mkvmerge.exe'
-        self.core = vs.get_core()
-        self.__trim_holder = []
-        self.__clip_holder = []
-        self.__is_ordered = False
-        self.__fps_num = 30000
-        self.__fps_den = 1001
-        self.__cut_cmd = ''
-        self.__qp_lines = ''
-        self.__chapters = ''
-        self.chapter_names = []
+    def __find_audio(self, video_source):
+        """Finds the biggest aac/ac3 named like video_source, asking probe_cache first."""
+        if self.probe_cache is not None:
+            afile = self.probe_cache.audio_for(video_source)
+            if afile is not None:
+                return afile
 
-    @property
-    def chapters(self):
-        """A string containing the lines for a chapter file."""
-        return self.__chapters
+        raw_name = splitext(video_source)[0]
+        if '[' in raw_name or ']' in raw_name:
+            import string, random
+            safe_set = list(set(string.printable) - set(raw_name))
+            guard = random.choice(safe_set)
+            raw_name = raw_name.replace('[', guard)
+            raw_name = raw_name.replace(']', '[]]')
+            raw_name = raw_name.replace(guard, '[[]')
 
-    @property
-    def chapter_names(self):
-        """A list of strings to be used in the chapter output."""
-        return self.__chapter_names
+        aacs = glob.glob("{0}*.aac".format(raw_name))
+        ac3s = glob.glob("{0}*.ac3".format(raw_name))
+        potential_audio = aacs + ac3s
+        potential_audio.sort(key=lambda x: getsize(x), reverse=True)
+        if len(potential_audio) > 0:
+            afile = potential_audio[0]
+        else:
+            raise AudioCutterError('Cannot find audio file that matches given video file name')
+        if self.probe_cache is not None:
+            self.probe_cache.store_audio_for(video_source, afile)
+        return afile
 
-    @chapter_names.setter
-    def chapter_names(self, names):
-        self.__chapter_names = names
+    def __identify(self, afile):
+        """Returns a dict of track_id, codec, delay and duration (in ns) for afile.
 
-    @property
-    def cut_cmd(self):
-        """The mkvmerge command(s) that will be called, to show the timecodes.
+        The track id is the one that matters, and falls back to 0 if mkvmerge doesn't find an
+        audio track. codec and duration are None if mkvmerge is too old to report them.
+        """
+        if self.probe_cache is not None:
+            info = self.probe_cache.identify(afile)
+            if info is not None:
+                return info
 
-        Do note that the actual cutting method modifies this further, though not
-        the timecodes. If you just want to ensure that it's cutting in the right
-        spot, this is fine after cut_audio()
+        delay = _DELAY_RE.search(afile)
+        info = {'track_id': '0', 'codec': None, 'duration': None,
+                'delay': int(delay.group(1)) if delay else None}
+        with self.span('identify', file=afile):
+            info.update(self.__probe(afile))
 
-        Note that this command will come with two format string variables,
-        {0} for the input filename, and {1} for the output. cut_audio() handles
-        this for you though.
+        if self.probe_cache is not None:
+            self.probe_cache.store_identify(afile, info)
+        return info
+
+    def __probe(self, afile):
+        """Asks mkvmerge for afile's track_id and codec, and duration if it's new enough."""
+        from subprocess import check_output, CalledProcessError
+
+        info = {}
+        try:
+            ident = json.loads(check_output([self.__mkvmerge, "--identification-format", "json",
+                                             "--identify", afile]).decode('utf-8'))
+            tracks = [t for t in ident.get('tracks', []) if t.get('type') == 'audio']
+            if tracks:
+                info['track_id'] = str(tracks[0]['id'])
+                info['codec'] = tracks[0].get('codec')
+            info['duration'] = ident.get('container', {}).get('properties', {}).get('duration')
+        except (CalledProcessError, ValueError):
+            # mkvmerge before 8.6 has no JSON output, so scrape the plain text instead
+            ident = check_output([self.__mkvmerge, "--identify", afile])
+            identre = re.compile(r"Track ID (\d+): audio(?: \((.*?)\))?")
+            ret = (identre.search(ident.decode(sys.getfilesystemencoding())) if ident else None)
+            if ret:
+                info['track_id'], info['codec'] = ret.group(1), ret.group(2)
+        return info
+
+    def __cut_raw(self, afile, outfile, delay_ms):
+        """Cuts a raw aac/ac3 file by copying whole frames, returning False if it can't.
+
+        The stream is memory mapped and scanned for frame boundaries, then every trim is mapped
+        to the nearest frame boundaries and those bytes are written straight out. A positive
+        delay means the audio starts that much later than the video, so a trim's audio starts
+        that much earlier in the file. If that would be before the start of the file, we'd need
+        to make up silence, so that's left to mkvmerge.
         """
-        return self.__cut_cmd
+        import mmap
+
+        codec = splitext(afile)[1][1:].lower()
+        if codec not in ('aac', 'ac3'):
+            return False
+        with self.span('native_cut', file=afile) as stage:
+            stage['bytes_read'] = getsize(afile)
+            with open(afile, 'rb') as f:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:  # Empty file, which mmap refuses
+                    return False
+            try:
+                index = _index_raw_audio(mm, codec)
+                if index is None:
+                    return False
+                offsets, rate, spf = index
+                frame_count = len(offsets) - 1
+                index = self.__source_timestamps()
+                delay = Fraction(delay_ms, 1000)
+                ranges = []
+                for trim in self.__merge_adjacent():
+                    s = round((index.time(trim[0]) - delay) * rate / spf)
+                    e = round((index.time(trim[1] + 1) - delay) * rate / spf)
+                    if s < 0:
+                        return False
+                    ranges.append((min(s, frame_count), min(e, frame_count)))
+                with open(outfile, 'wb') as o, memoryview(mm) as view:
+                    for s, e in ranges:
+                        o.write(view[offsets[s]:offsets[e]])
+            finally:
+                mm.close()
+            stage['bytes_written'] = getsize(outfile)
+            return True
+
+    def __merge_adjacent(self):
+        """Merges cuts that are a frame apart into a single cut.
+
+        This may be unnecessary since this tool requires mkvtoolnix to support split parts,
+        but since the standard for cutting appears to be to increment end timecodes by one,
+        adjacent start and end times would be identical, and that may not actually yield intended
+        results. Or it might. It's honestly not worth testing, given how easy this is.
+        """
+        previous = None
+        for trim in self.__trim_holder:
+            if previous is not None and previous[1] + 1 == trim[0]:
+                previous = (previous[0], trim[1])
+            else:
+                if previous is not None:
+                    yield previous
+                previous = trim
+        if previous is not None:
+            yield previous
+
+    def __source_timestamps(self):
+        """The TimestampIndex of the source as of prepare_cut(), which the audio is cut with."""
+        if self.__cut_timestamps is None:
+            return self.timestamps
+        return self.__cut_timestamps
+
+    def __frame_to_timecode(self, fn, msp=False):
+        """Takes a frame number and returns a timecode of type HH:MM:SS.nnnnnnnnn
+
+        I'm sure nanosecond precision is never, ever useful, but it's better to round
+        as late as possible.
+        """
+        return self.__source_timestamps().timecode(fn, msp)
+
+    def __check_ordered(self):
+        """Checks whether the first frame of a trim comes strictly after the last of the previous.
+
+        Out of order cuts are acceptable, and the audio cutting even supports it, unlike
+        split_aud.pl or vfr.py, but it is more complicated, so not going down that path is
+        encouraged if unnecessary. set_trims() already worked this out while validating.
+        """
+        return self.__is_ordered
+
+    def __unordered_pieces(self):
+        """Cuts out of order trims into the pieces of the source they're made of.
+
+        Every trim boundary starts a new piece, so no piece is partly in a trim, and each bit of
+        the source is in at most one piece however many trims use it. Returns the (start, end)
+        frames of the pieces in source order, with ends exclusive, and the piece numbers in the
+        order they need appending.
+        """
+        depth_changes = {}
+        for trim in self.__trim_holder:
+            depth_changes[trim[0]] = depth_changes.get(trim[0], 0) + 1
+            depth_changes[trim[1] + 1] = depth_changes.get(trim[1] + 1, 0) - 1
+        bounds = sorted(depth_changes)
+        pieces = []
+        depth = 0
+        for start, end in zip(bounds, bounds[1:]):
+            depth += depth_changes[start]
+            if depth:
+                pieces.append((start, end))
+
+        first = {piece[0]: i for i, piece in enumerate(pieces)}
+        last = {piece[1]: i for i, piece in enumerate(pieces)}
+        order = []
+        for trim in self.__trim_holder:
+            order.extend(range(first[trim[0]], last[trim[1] + 1] + 1))
+        return pieces, order
+
+    def __prepare_audio_cut_lines(self):
+        if self.__check_ordered():
+            cmd = self.__mkvmerge + "{2} --split parts:" + ",+".join(
+                "{}-{}".format(s, e) for s, e in self.iter_split_parts())
+        else:
+            # One pass splits out every piece to {3}/piece-001.mka and on, and a second one
+            # strings them together in trim order
+            pieces, order = self.__unordered_pieces()
+            parts = ','.join('{}-{}'.format(self.__frame_to_timecode(s),
+                                            self.__frame_to_timecode(e)) for s, e in pieces)
+            tmpfiles = '" ")" + "(" "'.join('{{3}}/piece-{:03d}.mka'.format(x + 1) for x in order)
+            appends = ','.join('{}:0:{}:0'.format(x+1, x) for x in range(len(order) - 1)) # filenames I 1 indexed, which adds an off-by-one
+            cmd = ''.join([
+                '"{}" {{2}} --split parts:{} -o "{{3}}/piece-%03d.mka" "{{0}}"\n'.format(
+                    self.__mkvmerge, parts),
+                '"{}"  "(" "{}" ")" -o "{{1}}"'.format(self.__mkvmerge, tmpfiles),
+                ' --append-to {}'.format(appends)])
+        self.__cut_cmd = cmd
+
+
+class AudioCutter(Timeline):
+    """A tool to cut audio and generate associated chapters/qpfiles for vapoursynth."""
+
+    def __init__(self):
+        """Bog standard initialization. There are no possible arguments."""
+        if vs is None:
+            raise ImportError("AudioCutter needs vapoursynth. Use Timeline to work without it.")
+        super(AudioCutter, self).__init__()
+        self.core = vs.core
+        self.__clip_holder = []
+        self.__joined_frames = None
+        self.__audio = None
+        self.__review_table = []
+        self.metric_cache = MetricCache()
 
-    @property
-    def qp_lines(self):
-        """Returns the lines that would be output to a qpfile."""
-        return self.__qp_lines
-        
     def get_segment(self, idx):
         return self.__clip_holder[idx]
     
@@ -69,8 +1701,8 @@ class AudioCutter(object):
         
     def segment_count(self):
         return len(self.__clip_holder)
-     
-    def split(self, vid, trims, doublecheck=False, join=True):
+
+    def split(self, vid, trims, doublecheck=False, join=True, snap=0, source=None, audio=None):
         """Takes a list of 2-tuples of frame numbers and returns the trimmed/spliced video.
 
         The 2-tuples must have positive frame numbers, and the second member must be greater
@@ -94,183 +1726,320 @@ class AudioCutter(object):
         If doublecheck is True, the filter will return a series of three frame tryptichs, with
         each being the first frame of a cut flanked by the previous/next frames, and then the last
         frame of a cut in the same way. This feature exists to safeguard against mistyping frame
-        numbers.
+        numbers. The tryptichs are all one clip that only looks up its frames when they're
+        requested, so it's just as quick to build for a hundred cuts as for two. Frame 2K is the
+        start of cut K, and 2K+1 its end (see review_frame() and review_table).
+
+        If snap is set to a number of frames, every trim boundary is first moved to the nearest
+        scene change or black frame within that many frames, using snap_trims(). source is the
+        file name of vid, which lets the measurements be cached between runs.
+
+        If audio is given, it is cut with the same trims at the exact samples they start and end
+        at, and left in the audio property, spliced in step with the video, so vspipe can encode
+        it straight away without cut_audio() and an intermediate mka. audio can be an AudioNode,
+        the name of an audio file, or True to look for one named like source, the same way
+        cut_audio()'s video_source does. Files are loaded with BestAudioSource (core.bas), and
+        any DELAY in their name is applied, padding with silence where the audio starts late.
         
-        If join is set to true, it will join the segments immediately. If it is not, the segments
+        If join is set to true, it will join the segments immediately, with trims that are back
+        to back joined into one segment first (its SegmentIdx frame property is the number of
+        the first of them). If it is not, every trim is its own segment, and they
         will remain in their array, waiting for you to process further. This would allow you to perform
         per-segment filtering, such as fancy IVTC tricks. Also, by allowing IVTC to be performed before
         joining, there shouldn't be any estimation of frame count changes for chapters.
         """
-        safe, msg = self.__list_of_lists(trims)
-        if (not safe):
-            return self.core.text.Text(vid, msg)
-        max = vid.num_frames - 1
-        self.chapter_names = list(map(lambda x: x[2] if len(x) > 2 else None,
-                                      trims))
-        trims = list(map(lambda x: (x[0], x[1]) if x[1] > 0 else (x[0], max),
-                         trims))
-
-        self.__trim_holder = trims
-        valid, msg = self.__is_valid()
-        if (not valid):
-            return self.core.text.Text(vid, msg)
-
-        if doublecheck:
-            cut_counter = 0
-            for clip in self.__trim_holder:
-                if clip[0] > 0:
-                    c = self.core.std.StackHorizontal([vid[clip[0]-1], vid[clip[0]], vid[clip[0]+1]])
-                else:
-                    bc = self.core.std.BlankClip(vid, length=1).text.Text('This is Fake Frame -1', 6)
-                    c = self.core.std.StackHorizontal([bc, vid[clip[0]], vid[clip[0]+1]])
-                if self.chapter_names[cut_counter]:
-                    cut_name = self.chapter_names[cut_counter] + " Start"
-                else:
-                    cut_name = "Cut {} Start".format(cut_counter)
-                c = self.core.text.Text(c, cut_name, 5)
-                self.__clip_holder.append(c)
-
-                if clip[1] < max:
-                    c = self.core.std.StackHorizontal([vid[clip[1]-1], vid[clip[1]], vid[clip[1]+1]])
-                else:
-                    bc = self.core.std.BlankClip(vid, length=1).text.Text('This is Fake Frame len+1', 4)
-                    c = self.core.std.StackHorizontal([vid[clip[1]-1], vid[clip[1]], bc])
-                if self.chapter_names[cut_counter]:
-                    cut_name = self.chapter_names[cut_counter] + " End"
-                else:
-                    cut_name = "Cut {} End".format(cut_counter)
-                c = self.core.text.Text(c, cut_name, 5)
-                self.__clip_holder.append(c)
-                cut_counter += 1
-        else:
-            i = 0
-            for clip in self.__trim_holder:
-                clp = vid[clip[0]:clip[1]+1]
-                clp = self.core.std.SetFrameProp(clp, prop="SegmentIdx", intval=i)
-                i += 1
-                self.__clip_holder.append(clp)
-            self.__fps_num = vid.fps_num
-            self.__fps_den = vid.fps_den
-
-            self.__prepare_audio_cut_lines(vid)
+        with self.span('split') as stage:
+            self.__audio = None
+            valid, msg = self.set_trims(trims, vid.num_frames)
+            if (not valid):
+                return self.core.text.Text(vid, msg)
+            # One copy of the trims for the whole split, rather than a new list every time
+            trims = self.trims
+            stage['trims'] = len(trims)
+            if snap:
+                names = self.chapter_names
+                valid, msg = self.set_trims(self.snap_trims(vid, trims, snap, source=source),
+                                            vid.num_frames)
+                if (not valid):
+                    return self.core.text.Text(vid, "After snapping: " + msg)
+                self.chapter_names = names
+                trims = self.trims
+
+            if doublecheck:
+                self.__clip_holder.append(self.__review_clip(self.__review_entries(vid)))
+            else:
+                # When joining, trims that are back to back become a single segment, so thousands
+                # of generated trims don't turn into thousands of nodes
+                runs = []
+                for i, (start, end) in enumerate(trims):
+                    if join and runs and runs[-1][2] + 1 == start:
+                        runs[-1][2] = end
+                    else:
+                        runs.append([i, start, end])
+                for i, start, end in runs:
+                    clp = vid[start:end+1]
+                    clp = self.core.std.SetFrameProp(clp, prop="SegmentIdx", intval=i)
+                    self.__clip_holder.append(clp)
+                # Slicing stops at the end of vid, so count the frames each trim really has
+                self.__joined_frames = None
+                if len(runs) < len(trims):
+                    self.__joined_frames = [min(end + 1, vid.num_frames) - min(start, vid.num_frames)
+                                            for start, end in trims]
+                self.prepare_cut(vid.fps_num, vid.fps_den)
+                if audio is not None:
+                    try:
+                        self.__audio = self.__cut_audio_node(audio, source)
+                    except AudioCutterError as e:
+                        return self.core.text.Text(vid, str(e))
         
-        if join:
-            return self.core.std.Splice(self.__clip_holder)
-        else:
-            return self.core.text.Text(self.__clip_holder[0], "Not joining, so only returning the "
-                                                                   "first segment with this message.", 5)
+            if join:
+                return self.core.std.Splice(self.__clip_holder)
+            else:
+                return self.core.text.Text(self.__clip_holder[0], "Not joining, so only returning the "
+                                                                       "first segment with this message.", 5)
     
-    def join(self, update_framerate=False):
-        """Joins a delayed split.
-        
-        As this allows per-segment filtering rather than scene filtering, it is probably only
-        really useful for IVTC pattern changes. If you are performing IVTC before joining, you
-        probably want to set update_framerate to True here. Doing so will take __clip_holder[0]'s
-        framerate and update the internal holders to it, so that ready_qp_and_chapters() multiplies
-        in a 1 at framerate scale time, rather than adjusting to the decimated rate.
-        
-        This won't work with vfr, but I'm not sure the chapters would even with default handling.
+    @property
+    def audio(self):
+        """The audio cut by the last split() that was given audio, or None."""
+        return self.__audio
+
+    def __cut_audio_node(self, audio, source):
+        """Loads audio if it's a file, and cuts it at the samples the trims start and end at."""
+        delay_ms = None
+        if audio is True:
+            if source is None:
+                raise AudioCutterError("audio=True needs source to look for the audio by")
+            audio, delay_ms = self.find_audio(video_source=source)
+        elif isinstance(audio, str):
+            audio, delay_ms = self.find_audio(audio_source=audio)
+        if isinstance(audio, str):
+            if not hasattr(self.core, 'bas'):
+                raise AudioCutterError("Loading audio needs the BestAudioSource plugin (core.bas)")
+            audio = self.core.bas.Source(audio)
+
+        pieces = []
+        for start, end in self.iter_audio_ranges(audio.sample_rate, delay_ms):
+            if start < 0:
+                pieces.append(self.core.std.BlankAudio(clip=audio, length=min(end, 0) - start))
+            if max(start, 0) < min(end, audio.num_samples):
+                pieces.append(audio[max(start, 0):min(end, audio.num_samples)])
+            if end > audio.num_samples:
+                pieces.append(self.core.std.BlankAudio(clip=audio,
+                                                       length=end - max(start, audio.num_samples)))
+        if not pieces:
+            raise AudioCutterError("There are no trims to cut the audio with")
+        return pieces[0] if len(pieces) == 1 else self.core.std.AudioSplice(pieces)
+
+    @property
+    def review_table(self):
+        """A list of (label, frame) for every frame of the last doublecheck/review clip.
+
+        frame is the frame number in the source clip that is in the middle of the tryptich.
         """
-        if update_framerate:
-            self.__fps_num = self.__clip_holder[0].fps_num
-            self.__fps_den = self.__clip_holder[0].fps_den
-        return self.core.std.Splice(self.__clip_holder)
-                                                                   
-    def cut_audio(self, outfile, video_source=None, audio_source=None, aac_is_sbr=False):
-        """Cuts the supplied audio file, based on trims from AudioCutter.split()
+        return [(label, fn) for clip, fn, label in self.__review_table]
 
-        video_source is intended for use with a video type where you've either manually
-        demuxed an audio track to the same name as your source (e.g. tsmuxer + LSMASHSource),
-        or generated an index file that demuxes the audio in a very similar way
-        (e.g dgindex + d2v.Source). It will search for filenames that begin with the video name,
-        but have an aac or ac3 extension, as these are the most likely output from those types
-        of sources (DVDs/Transport streams). It always uses the largest available file, so don't
-        use this option if for some reason you have ac3 and aac files that are similar to your
-        source name, unless you're sure you want the ac3, as it will be bigger. This is mutually
-        exclusive with audio_source.
+    def review_frame(self, cut, end=False):
+        """Returns the doublecheck clip frame number showing the start (or end) of cut number cut."""
+        return cut * 2 + (1 if end else 0)
 
-        audio_source simply takes an audio file name, in case your audio isn't so strictly named
-        like your video. This is mutually exclusive with video_source.
-        
-        aac_is_sbr should be set to true if your audio file is an he-aac file that is using spectral
-        band replication sbr. Older versions of audiocutter and its predecessor split_aud.pl checked
-        automatically using mkvmerge's --identify-for-mmg, but that is gone and the replacement is 
-        much too complex for auto-setting a single boolean that is almost never True. If you don't know
-        if your aac is a low bitrate HE-AAC/AAC+ with SBR, it probably isn't.
+    def review_episodes(self, episodes):
+        """Builds one doublecheck clip covering several episodes at once.
 
-        outfile should be fairly straightforward.
+        episodes is a list of (clip, trims) pairs, with trims in the same form split() takes.
+        The labels get the episode number (starting from 1) in front. All the clips have to share
+        the same format and dimensions. This doesn't touch the trims stored for this AudioCutter.
         """
-        from subprocess import check_output, call
+        entries = []
+        for ep, (vid, trims) in enumerate(episodes, 1):
+            timeline = Timeline(trims, vid.num_frames, vid.fps_num, vid.fps_den)
+            entries += [(clip, fn, "Ep {} {}".format(ep, label)) for clip, fn, label in
+                        self.__review_entries(vid, timeline)]
+        return self.__review_clip(entries)
 
-        if video_source is None and audio_source is None:
-            exit("You didn't supply any audio to cut")
-        elif (video_source is not None) and (audio_source is not None):
-            exit("Please supply only one of video_source or audio_source")
-        elif video_source is None:
-            afile = audio_source
-        else:
-            raw_name = splitext(video_source)[0]
-            if '[' in raw_name or ']' in raw_name:
-                import string, random
-                safe_set = list(set(string.printable) - set(raw_name))
-                guard = random.choice(safe_set)
-                raw_name = raw_name.replace('[', guard)
-                raw_name = raw_name.replace(']', '[]]')
-                raw_name = raw_name.replace(guard, '[[]')
-
-            aacs = glob.glob("{0}*.aac".format(raw_name))
-            ac3s = glob.glob("{0}*.ac3".format(raw_name))
-            potential_audio = aacs + ac3s
-            potential_audio.sort(key=lambda x: getsize(x), reverse=True)
-            if len(potential_audio) > 0:
-                afile = potential_audio[0]
-            else:
-                sys.exit('Cannot find audio file that matches given video file name')
+    def read_timestamps(self, vid, workers=4):
+        """Builds the source TimestampIndex from the _DurationNum/_DurationDen of every frame.
 
-        if afile.endswith('aac') and aac_is_sbr:
-            sbr = "0:1"
-        else:
-            sbr = None
+        This is for variable framerate sources, and has to be done before split(). It has to
+        request every single frame of vid, using up to workers threads, so if the source filter
+        can write a v2 timecodes file, read_timecodes() on that is much quicker. Frames without
+        a duration are assumed to last one frame at the clip's framerate.
+        """
+        with self.span('read_timestamps', frames=vid.num_frames):
+            from concurrent.futures import ThreadPoolExecutor
 
-        ident = check_output([self.__mkvmerge, "--identify", afile])
-        identre = re.compile("Track ID (\d+): audio")
-        ret = (identre.search(ident.decode(sys.getfilesystemencoding())) if ident else None)
-        tid = ret.group(1) if ret else '0'
-        delre = re.compile('DELAY ([-]?\d+)', flags=re.IGNORECASE)
-        ret = delre.search(afile)
+            def duration(n):
+                props = vid.get_frame(n).props
+                if '_DurationNum' in props and '_DurationDen' in props:
+                    return (props['_DurationNum'], props['_DurationDen'])
+                if not vid.fps_num:
+                    raise ValueError("Frame {} has no duration, and the clip has no framerate".format(n))
+                return (vid.fps_den, vid.fps_num)
 
-        delay = '{0}:{1}'.format(tid, ret.group(1)) if ret else None
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                durations = list(pool.map(duration, range(vid.num_frames)))
+            self.set_timestamps(TimestampIndex.from_durations(durations))
 
-        final_cut = self.__cut_cmd
-        if delay:
-            delay_statement = " --sync {}".format(delay)
-        else:
-            delay_statement = ''
-        if sbr:
-            final_cut += " --aac-is-sbr {}".format(sbr)
+    def verify_boundaries(self, vid, scene_threshold=10.0, black_threshold=24.0, workers=4,
+                          size=(64, 36)):
+        """Checks that every cut starts and ends on a scene change or a black frame.
 
-        
+        This is the automated version of eyeballing the doublecheck output. For each trim, the
+        first frame is compared with the one before it, and the last frame with the one after
+        it, using tiny greyscale copies of the frames. A boundary is fine if the average
+        difference between the two is at least scene_threshold (out of 255), or if either of
+        them is darker than black_threshold on average, as happens with fades. Everything else
+        is flagged as suspicious, and those are the ones worth a look with doublecheck. Cuts
+        at the very start or end of the clip have nothing to compare with and are never flagged.
 
-        if self.__is_ordered:
-            final_cut += ' -o {1} "{0}"'
+        vid should be the source clip that was passed to split(). Frames are requested by up to
+        workers threads at once. size is the (width, height) the frames are shrunk to first.
 
-            self.__cut_cmd = final_cut
-            args = shlex.split(final_cut.format(afile, outfile, delay_statement))
-            cutExec = call(args)
-        else:
-            final_cut = final_cut.format(afile,outfile, delay_statement)
-            cmds = final_cut.split('\n')
-            for cmd in cmds:
-                print(cmd)
-                args = shlex.split(cmd)
-                cutExec = call(args)
-                
-
-        if cutExec == 1:
-            print("Mkvmerge exited with warnings: {0:d}".format(cutExec))
-        elif cutExec == 2:
-            print(args)
-            exit("Failed to execute mkvmerge: {0:d}".format(cutExec))
+        Needs numpy. Returns a list with a dict for every boundary, holding cut (the trim index),
+        label, edge ('start' or 'end'), frame, diff and luma (the darker of the two frames), and
+        suspicious, all plain python values so it can go straight into json.dump().
+        """
+        with self.span('verify_boundaries'):
+            import numpy as np
+
+            checks = []
+            names = self.chapter_names
+            for i, trim in enumerate(self.trims):
+                label = names[i] if i < len(names) and names[i] else "Cut {}".format(i)
+                checks.append((i, label, 'start', trim[0], trim[0] - 1, trim[0]))
+                checks.append((i, label, 'end', trim[1], trim[1], trim[1] + 1))
+            checks = [c for c in checks if c[4] >= 0 and c[5] < vid.num_frames]
+
+            wanted = sorted(set(n for c in checks for n in c[4:]))
+            sigs = dict(self.__signatures(self.__signature_clip(vid, size), wanted, workers))
+
+            report = []
+            for cut, label, edge, fn, a, b in checks:
+                diff = float(np.abs(sigs[a] - sigs[b]).mean())
+                luma = float(min(sigs[a].mean(), sigs[b].mean()))
+                report.append({'cut': cut, 'label': label, 'edge': edge, 'frame': fn,
+                               'diff': round(diff, 3), 'luma': round(luma, 3),
+                               'suspicious': diff < scene_threshold and luma >= black_threshold})
+            return report
+
+    def suggest_boundaries(self, vid, trims=None, window=12, scene_threshold=10.0,
+                           black_threshold=24.0, workers=4, size=(64, 36), source=None):
+        """Looks for a scene change or black frame near every trim boundary.
+
+        trims defaults to the ones from the last split(), and must be valid if given. For the
+        start of a trim, a good spot is a frame that differs from the previous one by at least
+        scene_threshold (see verify_boundaries()), or the first frame after a black one. For the
+        end, it's the same, but for the frame after. The nearest good spot within window frames
+        either way is suggested, and boundaries with none nearby are left alone.
+
+        Frames are streamed through up to workers threads, and nothing but a few numbers per
+        frame is kept. If source is the file name of vid, those numbers are kept in
+        metric_cache as well, so running this again doesn't look at a single frame.
+
+        Needs numpy. Returns a list of dicts with cut, edge ('start' or 'end'), frame, suggested
+        (None if nothing was found) and diff, the difference at the suggested spot.
+        """
+        with self.span('suggest_boundaries'):
+            trims = self.trims if trims is None else trims
+            metrics = self.__load_metrics(source, size)
+            last = vid.num_frames - 1
+
+            # A boundary at frame fn is judged by the change into frame fn for starts, and into
+            # fn + 1 for ends, so both boil down to "is there a cut right before frame n?"
+            wanted = set()
+            for trim in trims:
+                for n in (trim[0], trim[1] + 1):
+                    wanted.update(range(max(1, n - window), min(last, n + window) + 1))
+            self.__measure(vid, sorted(wanted), metrics, workers, size)
+            self.__save_metrics(source, size, metrics)
+
+            def is_cut(n):
+                if metrics['diff'][n] >= scene_threshold:
+                    return True
+                return metrics['luma'][n - 1] < black_threshold <= metrics['luma'][n]
+
+            def is_end(n):
+                if metrics['diff'][n] >= scene_threshold:
+                    return True
+                return metrics['luma'][n - 1] >= black_threshold > metrics['luma'][n]
+
+            suggestions = []
+            for i, trim in enumerate(trims):
+                for edge, n, good in (('start', trim[0], is_cut), ('end', trim[1] + 1, is_end)):
+                    found = None
+                    if 0 < n <= last:
+                        for d in sorted(range(-window, window + 1), key=abs):
+                            if 0 < n + d <= last and good(n + d):
+                                found = n + d
+                                break
+                    fn = n if edge == 'start' else n - 1
+                    suggested = found if edge == 'start' or found is None else found - 1
+                    suggestions.append({'cut': i, 'edge': edge, 'frame': fn, 'suggested': suggested,
+                                        'diff': (round(metrics['diff'][found], 3)
+                                                 if found is not None else None)})
+            return suggestions
+
+    def snap_trims(self, vid, trims, window=12, **kwargs):
+        """Returns trims with every boundary moved to suggest_boundaries()' suggestion.
+
+        Anything past the first two members of a trim (chapter names) is kept as is. Keyword
+        arguments are passed along to suggest_boundaries().
+        """
+        trims = [list(t) for t in trims]
+        for s in self.suggest_boundaries(vid, trims, window, **kwargs):
+            if s['suggested'] is not None:
+                trims[s['cut']][0 if s['edge'] == 'start' else 1] = s['suggested']
+        return [tuple(t) for t in trims]
+
+    def scan_scene_changes(self, vid, stride=8, scene_threshold=10.0, workers=4, size=(64, 36),
+                           source=None):
+        """Finds every scene change in vid, returning the first frame of each new scene.
+
+        Looking at every frame of a whole episode is slow, so only every stride-th frame is
+        compared with the one stride frames before it, and only stretches where that shows a
+        big enough difference are looked at frame by frame. A scene that lasts less than stride
+        frames and cuts back to something similar can slip through. Use the results for picking
+        trims by hand, or just to see what's there. The other arguments work like they do for
+        suggest_boundaries(). Needs numpy.
+        """
+        with self.span('scan_scene_changes', frames=vid.num_frames):
+            metrics = self.__load_metrics(source, size)
+            coarse = metrics['coarse'].setdefault(stride, {})
+            todo = [n for n in range(stride, vid.num_frames, stride) if n not in coarse]
+            if todo:
+                import numpy as np
+
+                previous = None
+                frames = sorted(set(todo) | set(n - stride for n in todo))
+                for n, sig in self.__signatures(self.__signature_clip(vid, size), frames, workers):
+                    if previous is not None and previous[0] == n - stride:
+                        coarse[n] = float(np.abs(sig - previous[1]).mean())
+                    previous = (n, sig)
+                self.__save_metrics(source, size, metrics)
+
+            fine = []
+            for n in sorted(coarse):
+                if coarse[n] >= scene_threshold:
+                    fine.extend(range(n - stride + 1, n + 1))
+            self.__measure(vid, fine, metrics, workers, size)
+            self.__save_metrics(source, size, metrics)
+
+            return [n for n in fine if metrics['diff'][n] >= scene_threshold]
+
+    def join(self, update_framerate=False):
+        """Joins a delayed split.
+        
+        As this allows per-segment filtering rather than scene filtering, it is probably only
+        really useful for IVTC pattern changes. If you are performing IVTC before joining, you
+        probably want to set update_framerate to True here. Doing so will take __clip_holder[0]'s
+        framerate and update the internal holders to it, so that ready_qp_and_chapters() multiplies
+        in a 1 at framerate scale time, rather than adjusting to the decimated rate.
+        
+        This won't work with vfr. For variable framerate sources, use read_timestamps() or
+        read_timecodes() before split() instead, and leave the framerate alone.
+        """
+        if update_framerate:
+            self.set_framerate(self.__clip_holder[0].fps_num, self.__clip_holder[0].fps_den)
+        return self.core.std.Splice(self.__clip_holder)
 
     def ready_qp_and_chapters(self, vid):
         """Populates qp_lines and chapters based on frames passed to split()
@@ -293,174 +2062,256 @@ class AudioCutter(object):
         potentially having the chapter IDR point one frame later than the chapter start
         timecode.
         """
-        # Calculate the scalar value for fps change first
-        inverse_source_fps = Fraction(self.__fps_den, self.__fps_num)
-        current_fps = Fraction(vid.fps_num, vid.fps_den)
-        scalar = inverse_source_fps * current_fps
-
-        # Now update it for the chapter timecodes
-        self.__fps_num = current_fps.numerator
-        self.__fps_den = current_fps.denominator
-
-        f = [x.num_frames * scalar for x in self.__clip_holder]
-        f2 = [f[0]]
-        for i in range(1, len(f) - 1):
-            f2.append(f2[i-1]+f[i])
-        ch_start_frames = [int(x) for x in f2]
-        self.__qp_lines = ' K\n'.join(list(map(str, ch_start_frames))) + ' K\n'
-        ch_start_frames.insert(0, 0)
-        i = 1
-        ch_string = ""
-        names = self.chapter_names
-        for chap in ch_start_frames:
-            tc = self.__frame_to_timecode(chap, True)
-            ch_string += "CHAPTER{0:02d}={1}\n".format(i, tc)
-            fallback_name = "CHAPTER{0:02d}NAME=Chapter {0:02d}\n".format(i)
-            try:
-                if names[i-1]:
-                    ch_string += "CHAPTER{0:02d}NAME={1}\n".format(i, names[i-1])
-                else:
-                    ch_string += fallback_name
-            except IndexError:
-                ch_string += fallback_name
-            i += 1
-        self.__chapters = ch_string
+        # Joined segments may hold several trims, but then they weren't filtered separately
+        # either, so the lengths of the trims themselves are right
+        segment_frames = self.__joined_frames
+        if segment_frames is None:
+            segment_frames = [x.num_frames for x in self.__clip_holder]
+        Timeline.ready_qp_and_chapters(self, vid.fps_num, vid.fps_den, segment_frames)
 
-    def write_qpfile(self, outfile):
-        """Writes qp_lines to outfile.
+    def __signature_clip(self, vid, size):
+        """Shrinks vid down to a tiny 8-bit greyscale clip for cheap frame comparisons."""
+        args = {'format': vs.GRAY8}
+        if vid.format.color_family == vs.RGB:
+            args['matrix_s'] = '709'
+        return self.core.resize.Bilinear(vid, size[0], size[1], **args)
 
-        Obviously, this is of limited use if you have not run ready_qp_and_chapters(),
-        as the default is an empty string, but that operation should succeed.
+    def __signatures(self, clip, frames, workers):
+        """Yields (frame number, luma array) for frames in order, fetching several at once.
+
+        Only about two frames per worker are ever waiting around, so this can stream through
+        an entire clip without holding it in memory.
         """
-        try:
-            with open(outfile, 'w') as o:
-                o.write(self.qp_lines)
-        except IOError:
-            print("Error writing to qpfile: {}".format(outfile), file=sys.stderr)
-            raise
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
 
-    def write_chapters(self, outfile):
-        """Writes chapters to outfile.
+        def fetch(n):
+            return _luma_array(clip.get_frame(n))
 
-        Obviously, this is of limited use if you have not run ready_qp_and_chapters(),
-        as the default is an empty string, but that operation should succeed.
-        """
-        try:
-            with open(outfile, 'w') as o:
-                o.write(self.chapters)
-        except IOError:
-            print("Error writing to chapter file: {}".format(outfile), file=sys.stderr)
-            raise
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for n in frames:
+                pending.append((n, pool.submit(fetch, n)))
+                if len(pending) >= workers * 2:
+                    n, job = pending.popleft()
+                    yield n, job.result()
+            while pending:
+                n, job = pending.popleft()
+                yield n, job.result()
 
-    def __merge_adjacent(self):
-        """Merges cuts that are a frame apart into a single cut.
+    def __load_metrics(self, source, size):
+        if source is not None and self.metric_cache is not None:
+            return self.metric_cache.load(source, size)
+        return {'diff': {}, 'luma': {}, 'coarse': {}}
 
-        This may be unnecessary since this tool requires mkvtoolnix to support split parts,
-        but since the standard for cutting appears to be to increment end timecodes by one,
-        adjacent start and end times would be identical, and that may not actually yield intended
-        results. Or it might. It's honestly not worth testing, given how easy this is.
-        """
-        previous = (-3, -3)
-        merged_cuts = []
-        for trim in self.__trim_holder:
-            if previous[1] + 1 == trim[0]:
-                previous = (previous[0], trim[1])
-            else:
-                merged_cuts.append(previous)
-                previous = trim
-        merged_cuts.append(previous)
-        merged_cuts.pop(0)  # The loop may need that (-3,-3), but the output doesn't
-        return merged_cuts
+    def __save_metrics(self, source, size, metrics):
+        if source is not None and self.metric_cache is not None:
+            self.metric_cache.save(source, size, metrics)
 
-    def __frame_to_timecode(self, fn, msp=False):
-        """Takes a frame number and returns a timecode of type HH:MM:SS.nnnnnnnnn
+    def __measure(self, vid, frames, metrics, workers, size):
+        """Fills in metrics['diff'][n] and metrics['luma'] for n and n - 1, for all n in frames.
 
-        I'm sure nanosecond precision is never, ever useful, but it's better to round
-        as late as possible.
+        diff[n] is the mean absolute difference between frames n - 1 and n, and luma[n] is the
+        average brightness of frame n. Anything already in metrics isn't fetched again.
         """
-        ts = round(10 ** 9 * fn * Fraction(self.__fps_den, self.__fps_num))
-        s = ts / 10 ** 9
-        m = s // 60
-        s = s % 60
-        h = m // 60
-        m = m % 60
-        if msp:
-            return '{:02.0f}:{:02.0f}:{:06.3f}'.format(h, m, round(s, 3))
-        else:
-            return '{:02.0f}:{:02.0f}:{:012.9f}'.format(h, m, s)
+        import numpy as np
+
+        todo = [n for n in frames if n not in metrics['diff'] or n - 1 not in metrics['luma']]
+        if not todo:
+            return
+        previous = None
+        fetch = sorted(set(todo) | set(n - 1 for n in todo))
+        for n, sig in self.__signatures(self.__signature_clip(vid, size), fetch, workers):
+            metrics['luma'][n] = float(sig.mean())
+            if previous is not None and previous[0] == n - 1:
+                metrics['diff'][n] = float(np.abs(sig - previous[1]).mean())
+            previous = (n, sig)
 
-    def __list_of_lists(self, trims):
-        """Ensures that the trim list is a list of lists.
+    def __review_entries(self, vid, timeline=None):
+        """Lists (clip, frame, label) for the start and end of every trim."""
+        timeline = timeline or self
+        entries = []
+        names = timeline.chapter_names
+        for i, trim in enumerate(timeline.trims):
+            name = names[i] if i < len(names) and names[i] else "Cut {}".format(i)
+            entries.append((vid, trim[0], name + " Start"))
+            entries.append((vid, trim[1], name + " End"))
+        return entries
 
-        It does not actually enforce that you use a list of tuples, though that is preferred
-        just for stylistic reasons. It also doesn't ensure the data inside the sub-lists is
-        valid. This could probably be fixed with duck typing more carefully, but this seemed
-        easier, especially as pertains to writing the error to the video, so it's obvious what
-        has happened.
+    def __review_clip(self, entries):
+        """Builds a single lazily evaluated tryptich clip with a frame for each entry.
+
+        Rather than slicing and stacking three nodes per boundary, three FrameEval clips look up
+        the previous, current and next frame from the table when a frame is actually requested.
+        Frames before the start or past the end of a clip are stand ins with a warning on them.
         """
-        if(not isinstance(trims, (list, tuple))):
-            return False, "Did not pass a list of lists/tuples to split()"
-        else:
-            for trim in trims:
-                if (not isinstance(trim, (list, tuple))):
-                    return False, "One or more trims is not a list/tuple"
-        return True, ""
+        from functools import partial
 
-    def __is_valid(self):
-        """Ensures that the sub-lists contain two positive integers in ascending order.
+        self.__review_table = entries
+        length = len(entries)
+        base = self.core.std.BlankClip(entries[0][0], length=length)
+        fake_start = base.text.Text('This is Fake Frame -1', 6)
+        fake_end = base.text.Text('This is Fake Frame len+1', 4)
 
-        Any subclass of numbers.Integral will do here, in case you need something fancier
-        than integer literals. Also, having sub-tuples/sub-lists with more than two elements
-        is allowed, as long as the first two elements are what is expected.
+        def lookup(n, offset):
+            clip, fn, label = entries[n]
+            fn += offset
+            if fn < 0:
+                return fake_start
+            if fn >= clip.num_frames:
+                return fake_end
+            # FrameEval asks the returned clip for frame n, so line frame fn up with it
+            if fn >= n:
+                return clip[fn - n:]
+            return self.core.std.BlankClip(clip, length=n - fn) + clip
 
-        Note that nothing in the library consumes the remaining elements, even optionally,
-        but the process will not end because of their existence.
-        """
-        for trim in self.__trim_holder:
-            if (not (isinstance(trim[0], numbers.Integral) and
-                     isinstance(trim[1], numbers.Integral))):
-                return False, "One or more trims is not a group of two integers"
-            if ((trim[1] < trim[0]) or (trim[0] < 0)):
-                return False, "One or more trims is either out of order, or negative"
-        return True, ""
+        stacked = self.core.std.StackHorizontal([self.core.std.FrameEval(base, partial(lookup, offset=o))
+                                                 for o in (-1, 0, 1)])
+        return self.core.std.FrameEval(stacked, lambda n: stacked.text.Text(entries[n][2], 5))
 
-    def __check_ordered(self):
-        """Checks whether the first frame of a trim comes strictly after the last of the previous.
 
-        Out of order cuts are acceptable, and the audio cutting even supports it, unlike
-        split_aud.pl or vfr.py, but it is more complicated, so not going down that path is
-        encouraged if unnecessary.
-        """
-        previous = (-3, -3)
-        self.__is_ordered = True
-        for trim in self.__trim_holder:
-            if (previous[1] > trim[0]):
-                self.__is_ordered = False
-                break
-            previous = trim
-        return self.__is_ordered
+def run_batch(manifest, jobs=None, source_filter='lsmas.LWLibavSource', probe_cache=None,
+              result_cache=None, instrumentation=None):
+    """Cuts audio and writes qpfiles/chapters for a whole list of episodes in one go.
 
-    def __prepare_audio_cut_lines(self, vid):
-        self.__check_ordered()
-        if self.__is_ordered:
-            cmd = self.__mkvmerge + "{2} --split parts:"
-            merged_cuts = self.__merge_adjacent()
-            for trim in merged_cuts:
-                s = self.__frame_to_timecode(trim[0])
-                e = self.__frame_to_timecode(trim[1]+1)
-                cmd += "{}-{},+".format(s,e)
-            cmd = cmd[:-2]
+    manifest is either the name of a JSON file or the already loaded contents of one. It
+    should be a list of episodes (or a dict with that list under "episodes"), each of which
+    is a dict along the lines of:
+        {"source": "ep01.ts", "trims": [[1159, 6910, "Part A"], [9610, 21298]], "output": "01"}
+
+    source and trims are required, and trims are exactly what you would hand to split().
+    output is the prefix for the files written, defaulting to the source name without its
+    extension, and gets the same suffixes as example.vpy uses. audio_source, aac_is_sbr and
+    chapter_names are also accepted, and mean the same thing they do elsewhere in AudioCutter.
+
+    Everything vapoursynth related happens one episode at a time on the one shared core, which
+    is quick, while the mkvmerge side is handed off to a pool of jobs workers (one per core if
+    None) so the slow part overlaps across episodes. The workers are threads rather than
+    processes, as all they do is wait on mkvmerge, which is its own process already.
+
+    probe_cache is a ProbeCache shared by every episode, to skip probing audio that was already
+    looked at by an earlier run, and result_cache a ResultCache to skip cutting audio that was
+    already cut the same way.
+
+    instrumentation is an Instrumentation that times every episode's stages, with the episode's
+    output prefix added to each span as "episode", plus a "source" span for opening it.
+
+    A failed episode doesn't stop the rest. The return value is a list with a dict for each
+    episode, holding output, ok, seconds, queued and error (None if it worked). seconds is the
+    time spent working on the episode, opening it and writing its files plus cutting its audio,
+    and queued is how long the cut waited for a free worker in between, which isn't counted.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(manifest, str):
+        with open(manifest) as m:
+            manifest = json.load(m)
+    if isinstance(manifest, dict):
+        manifest = manifest['episodes']
+
+    core = vs.core
+    source = core
+    for name in source_filter.split('.'):
+        source = getattr(source, name)
+
+    def describe(e):
+        return str(e) or e.__class__.__name__
+
+    def cut(ac, ep, prefix, result, submitted):
+        # Timed here, as the main thread only gets to an episode's result after it has set up
+        # every later one
+        start = time.perf_counter()
+        result['queued'] = start - submitted
+        try:
+            if ep.get('audio_source'):
+                ac.cut_audio(prefix + '_aud_ac.mka', audio_source=ep['audio_source'],
+                             aac_is_sbr=ep.get('aac_is_sbr', False))
+            else:
+                ac.cut_audio(prefix + '_aud_ac.mka', video_source=ep['source'],
+                             aac_is_sbr=ep.get('aac_is_sbr', False))
+        finally:
+            result['seconds'] += time.perf_counter() - start
+
+    results = []
+    pending = []
+    with ThreadPoolExecutor(max_workers=jobs or cpu_count() or 1) as pool:
+        for ep in manifest:
+            start = time.perf_counter()
+            prefix = ep.get('output') or splitext(ep['source'])[0]
+            result = {'output': prefix, 'ok': False, 'seconds': 0.0, 'queued': 0.0,
+                      'error': None}
+            results.append(result)
+            try:
+                ac = AudioCutter()
+                ac.probe_cache = probe_cache
+                ac.result_cache = result_cache
+                if instrumentation is not None:
+                    ac.instrumentation = instrumentation.with_fields(episode=prefix)
+                with ac.span('source', file=ep['source']):
+                    vid = source(ep['source'])
+                # split() only writes the problem onto the video, so check first to report it
+                valid, msg = ac.set_trims(ep['trims'], vid.num_frames)
+                if (not valid):
+                    raise ValueError(msg)
+                vid = ac.split(vid, ep['trims'])
+                if 'chapter_names' in ep:
+                    ac.chapter_names = ep['chapter_names']
+                ac.ready_qp_and_chapters(vid)
+                ac.write_qpfile(prefix + '.qpfile')
+                ac.write_chapters(prefix + '_ch.txt')
+            except (Exception, SystemExit) as e:
+                result['seconds'] = time.perf_counter() - start
+                result['error'] = describe(e)
+                continue
+            submitted = time.perf_counter()
+            result['seconds'] = submitted - start
+            pending.append((result, pool.submit(cut, ac, ep, prefix, result, submitted)))
+
+        for result, job in pending:
+            try:
+                job.result()
+                result['ok'] = True
+            except (Exception, SystemExit) as e:
+                result['error'] = describe(e)
+    return results
+
+
+def main(argv=None):
+    """Command line front end for run_batch()."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Cut audio and write qpfiles/chapters for a '
+                                                 'list of episodes described in a JSON manifest.')
+    parser.add_argument('manifest', help='JSON file listing the episodes to process')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='how many mkvmerge jobs to run at once (default: one per core)')
+    parser.add_argument('-s', '--source-filter', default='lsmas.LWLibavSource',
+                        help='source filter used to open each episode (default: %(default)s)')
+    parser.add_argument('--probe-cache', action='store_true',
+                        help='remember audio probes between runs in the per-user cache folder')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='reuse audio cuts from earlier runs with the same audio and trims')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='append timings for every stage to FILE as JSON lines')
+    args = parser.parse_args(argv)
+
+    result_cache = ResultCache() if args.result_cache else None
+    results = run_batch(args.manifest, args.jobs, args.source_filter,
+                        ProbeCache() if args.probe_cache else None, result_cache,
+                        Instrumentation(args.profile) if args.profile else None)
+    for r in results:
+        if r['ok']:
+            print('{0}: done in {1:.1f}s, after waiting {2:.1f}s for a worker'.format(
+                r['output'], r['seconds'], r['queued']))
         else:
-            cmd = ""
-            i = 1
-            for trim in self.__trim_holder:
-                s = self.__frame_to_timecode(trim[0])
-                e = self.__frame_to_timecode(trim[1]+1)
-                cmd += '"{}" {{2}} --split parts:{}-{} -o tmp-{:03d}.mka "{{0}}"\n'.format(
-                    self.__mkvmerge, s, e, i)
-                i += 1
-            tmpfiles = '" ")" + "(" "'.join(['tmp-{:03d}.mka'.format(x) for x in range(1, i)])
-            cmd += '"{}"  "(" "{}" ")" -o "{{1}}"'.format(self.__mkvmerge, tmpfiles)
-            appends = ','.join(['{}:0:{}:0'.format(x+1, x) for x in range(i-2)]) # filenames I 1 indexed, which adds an off-by-one
-            cmd += ' --append-to {}'.format(appends)
-        self.__cut_cmd = cmd
+            print('{0}: FAILED after {1:.1f}s: {2}'.format(r['output'], r['seconds'], r['error']),
+                  file=sys.stderr)
+    failed = len([r for r in results if not r['ok']])
+    print('{0} of {1} episodes done'.format(len(results) - failed, len(results)))
+    if result_cache is not None:
+        print('{hits} audio cuts reused, {misses} cut'.format(**result_cache.stats))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""Times the AudioCutter pipeline and checks its output against known good results.
+
+Nothing here needs vapoursynth or mkvmerge. A stub core stands in for vapoursynth, handing
+out clips that only know their length, framerate and which source frame each frame shows,
+and a fake mkvmerge is written to a temp folder that logs what it was called with and writes
+dummy files. So this runs anywhere python does, and measures only what audiocutter itself
+costs.
+
+    python benchmark.py                    # time every stage, check golden output, record
+    python benchmark.py --counts 1 10 100  # only those trim counts
+    python benchmark.py --update-golden    # after an intentional change to the output
+
+Every run is appended to benchmark_results.jsonl (see --results), and each timing is
+compared with the last recorded run so slowdowns stand out.
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GOLDEN = os.path.join(HERE, 'benchmark_golden.json')
+
+FAKE_MKVMERGE = r'''
+import json, os, sys
+args = sys.argv[1:]
+if len(args) == 1 and args[0].startswith('@'):
+    with open(args[0][1:]) as f:
+        args = json.load(f)
+with open(os.environ['FAKE_MKVMERGE_LOG'], 'a') as log:
+    log.write(json.dumps(args) + '\n')
+if '--identify' in args:
+    if '--identification-format' in args:
+        print(json.dumps({'container': {'properties': {'duration': 1800000000000}},
+                          'tracks': [{'id': 0, 'type': 'audio', 'codec': 'AAC'}]}))
+    else:
+        print('File: container: AAC\nTrack ID 0: audio (AAC)')
+    sys.exit(0)
+for i, arg in enumerate(args[:-1]):
+    if arg == '-o':
+        names = [args[i + 1]]
+        if '%' in names[0]:
+            parts = args[args.index('--split') + 1][len('parts:'):].split(',')
+            count = len([p for p in parts if not p.startswith('+')])
+            names = [names[0] % n for n in range(1, count + 1)]
+        for name in names:
+            with open(name, 'wb') as o:
+                o.write(b'fake')
+'''
+
+
+class StubClip(object):
+    """Just enough of a vapoursynth clip for AudioCutter: a length, a framerate, and frames.
+
+    A frame is whatever shows(n) returns: a source clip's frames are their own frame numbers,
+    blank frames are 'blank', text is [text, frame] and stacked frames are lists, so render()
+    shows exactly which source frames ended up where.
+    """
+
+    def __init__(self, num_frames, fps_num=30000, fps_den=1001, shows=None):
+        self.num_frames = num_frames
+        self.fps_num = fps_num
+        self.fps_den = fps_den
+        self.shows = shows or (lambda n: n)
+        self.text = types.SimpleNamespace(Text=lambda text, *args, **kwargs: self.derive(
+            self.num_frames, lambda n: [text, self.shows(n)]))
+
+    def derive(self, num_frames, shows):
+        """A clip with this one's framerate, num_frames long, showing shows(n) for frame n."""
+        return StubClip(num_frames, self.fps_num, self.fps_den, shows)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            frames = range(*key.indices(self.num_frames))
+            return self.derive(len(frames), lambda n: self.shows(frames[n]))
+        return self.derive(1, lambda n: self.shows(key))
+
+    def __add__(self, other):
+        return splice([self, other])
+
+
+def splice(clips):
+    """Joins clips end to end, finding the clip for a frame with a binary search."""
+    starts = [0]
+    for c in clips:
+        starts.append(starts[-1] + c.num_frames)
+
+    def shows(n):
+        i = bisect.bisect_right(starts, n) - 1
+        return clips[i].shows(n - starts[i])
+    return clips[0].derive(starts[-1], shows)
+
+
+def render(clip):
+    """Every frame of clip, the way vspipe would ask for them."""
+    return [clip.shows(n) for n in range(clip.num_frames)]
+
+
+class StubCore(object):
+    """Stands in for a vapoursynth core, with only the filters AudioCutter uses."""
+
+    def __init__(self):
+        self.std = types.SimpleNamespace(
+            BlankClip=lambda clip, length=1, **kwargs: clip.derive(length, lambda n: 'blank'),
+            SetFrameProp=lambda clip, **kwargs: clip,
+            Splice=splice,
+            StackHorizontal=lambda clips: clips[0].derive(
+                clips[0].num_frames, lambda n: [c.shows(n) for c in clips]),
+            # Like the real one, eval is only called once the frame is asked for
+            FrameEval=lambda clip, eval: clip.derive(clip.num_frames, lambda n: eval(n).shows(n)))
+        self.text = types.SimpleNamespace(Text=lambda clip, text, *args, **kwargs:
+                                          clip.text.Text(text))
+
+
+def load_audiocutter():
+    """Imports audiocutter with the stub core in place of vapoursynth."""
+    stub = types.ModuleType('vapoursynth')
+    stub.get_core = StubCore
+    stub.core = StubCore()
+    stub.GRAY8 = 'GRAY8'
+    stub.RGB = 'RGB'
+    sys.modules['vapoursynth'] = stub
+    sys.path.insert(0, HERE)
+    import audiocutter
+    return audiocutter
+
+
+def make_fake_mkvmerge(folder):
+    """Writes the fake mkvmerge into folder and returns how to run it."""
+    script = os.path.join(folder, 'fake_mkvmerge.py')
+    with open(script, 'w') as f:
+        f.write(FAKE_MKVMERGE)
+    if os.name == 'nt':
+        exe = os.path.join(folder, 'mkvmerge.cmd')
+        with open(exe, 'w') as f:
+            f.write('@"{}" "{}" %*\n'.format(sys.executable, script))
+    else:
+        exe = os.path.join(folder, 'mkvmerge')
+        with open(exe, 'w') as f:
+            f.write('#!{}\n'.format(sys.executable) + FAKE_MKVMERGE)
+        os.chmod(exe, 0o755)
+    # audiocutter hands these to shlex, which wants forward slashes
+    return exe.replace('\\', '/')
+
+
+def make_adts(path, seconds):
+    """Writes a raw aac file of tiny ADTS frames at 48kHz, each holding its own frame number.
+
+    The numbers make a native cut's output show exactly which frames it kept.
+    """
+    size = 16
+    header = bytes([0xFF, 0xF1, (1 << 6) | (3 << 2), (2 << 6) | (size >> 11),
+                    (size >> 3) & 0xFF, ((size & 7) << 5) | 0x1F, 0xFC])
+    with open(path, 'wb') as f:
+        f.write(b''.join(header + n.to_bytes(size - len(header), 'big')
+                         for n in range(int(seconds * 48000 / 1024 + 1))))
+
+
+def make_trims(count, ordered=True, seed=0):
+    """Makes count trims like commercial detection would, some of them back to back."""
+    rng = random.Random(seed * 100003 + count)
+    trims = []
+    pos = 0
+    for i in range(count):
+        start = pos + rng.choice((0, 1, rng.randint(30, 2000)))
+        end = start + rng.randint(24, 3000)
+        trims.append((start, end, 'Part {}'.format(i)) if i % 3 == 0 else (start, end))
+        pos = end + 1
+    if not ordered:
+        rng.shuffle(trims)
+    return trims
+
+
+def timed(repeat, func):
+    """Runs func repeat times, returning the best time in seconds and the last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_stages(ac_mod, count, ordered, work, audio, raw_audio, repeat, cut_limit):
+    """Times each stage of the pipeline for one trim list, returning {stage: seconds}."""
+    trims = make_trims(count, ordered)
+    source = StubClip(trims and max(max(t[0], t[1]) for t in trims) + 100 or 100)
+    timings = {}
+
+    timings['set_trims'], _ = timed(repeat, lambda: ac_mod.Timeline().set_trims(trims))
+
+    def prepare():
+        tl = ac_mod.Timeline()
+        tl.set_trims(trims)
+        tl.prepare_cut(30000, 1001)
+        return tl
+    timings['prepare_cut'], tl = timed(repeat, prepare)
+
+    def split():
+        ac = ac_mod.AudioCutter()
+        ac.split(source, trims)
+        return ac
+    timings['split'], ac = timed(repeat, split)
+    # The review clip is built lazily, so render it to time what it costs to actually look at
+    timings['split_doublecheck'], _ = timed(
+        repeat, lambda: render(ac_mod.AudioCutter().split(source, trims, doublecheck=True)))
+
+    timings['ready_qp_and_chapters'], _ = timed(
+        repeat, lambda: ac.ready_qp_and_chapters(StubClip(1, 24000, 1001)))
+    timings['write_qpfile'], _ = timed(
+        repeat, lambda: ac.write_qpfile(os.path.join(work, 'bench.qpfile')))
+    timings['write_chapters'], _ = timed(
+        repeat, lambda: ac.write_chapters(os.path.join(work, 'bench_ch.txt')))
+
+    if count <= cut_limit:
+        out = os.path.join(work, 'bench.mka')
+        timings['cut_audio'], _ = timed(1, lambda: tl.cut_audio(out, audio_source=audio))
+        out = os.path.join(work, 'bench.aac')
+        timings['cut_audio_native'], _ = timed(
+            repeat, lambda: tl.cut_audio(out, audio_source=raw_audio))
+    return timings
+
+
+def golden_cases():
+    """The trim lists whose output is checked, by name."""
+    example = [(1159, 6910, 'A Chapter'), (6913, 9609, 'Another Chapter'),
+               (11862, 21298, 'These Names Will be overridden'), (23998, 34455),
+               (36255, 47523), (47524, 49711, 'By the line below'), (49712, 50461),
+               (50462, 51358, 'So pick a method')]
+    return {
+        'example': (example, (30000, 1001), (30000, 1001)),
+        'example_ivtc': (example, (30000, 1001), (24000, 1001)),
+        'unordered': ([(5000, 6000, 'B'), (100, 2000, 'A'), (2001, 2500), (8000, 0)],
+                      (30000, 1001), (30000, 1001)),
+        'pal': ([(0, 1499), (1500, 2999), (4000, 7499)], (25, 1), (25, 1)),
+        'generated': (make_trims(40), (30000, 1001), (24000, 1001)),
+    }
+
+
+def native_output(path):
+    """The number of ADTS frames in a native cut, the first and last of them, and a hash."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    frames = [int.from_bytes(data[i + 7:i + 16], 'big') for i in range(0, len(data), 16)]
+    return {'bytes': len(data), 'frames': len(frames),
+            'first_last': [frames[0], frames[-1]] if frames else None,
+            'sha1': hashlib.sha1(data).hexdigest()}
+
+
+def logged_calls(scrub=()):
+    """Empties the fake mkvmerge's log, returning the calls in it with scrub's paths replaced."""
+    log = os.environ['FAKE_MKVMERGE_LOG']
+    with open(log, 'a+') as f:
+        f.seek(0)
+        calls = [json.loads(line) for line in f]
+        f.truncate(0)
+    scrubbed = []
+    for call in calls:
+        call = json.dumps(call)
+        for old, new in scrub:
+            call = call.replace(json.dumps(old.replace('\\', '/'))[1:-1], new)
+            call = call.replace(json.dumps(old)[1:-1], new)
+        scrubbed.append(json.loads(call))
+    # Temp folder names and places vary, so only keep the files inside them
+    return [[re.sub(r'^.*[/\\]audiocutter-[^/\\]+', '<tmp>/audiocutter-*', a) for a in call]
+            for call in scrubbed]
+
+
+def golden_output(ac_mod, work, mkvmerge, audio, raw_audio):
+    """Runs every golden case and returns what it produced, with temp paths scrubbed out."""
+    results = {}
+    for name, (trims, source_fps, final_fps) in sorted(golden_cases().items()):
+        ac = ac_mod.AudioCutter()
+        review = render(ac.split(StubClip(60000, *source_fps), trims, doublecheck=True))
+        ac = ac_mod.AudioCutter()
+        ac.split(StubClip(60000, *source_fps), trims)
+        ac.ready_qp_and_chapters(StubClip(1, *final_fps))
+        logged_calls()
+        ac.cut_audio(os.path.join(work, 'golden.mka'), audio_source=audio)
+        results[name] = {'cut_cmd': ac.cut_cmd.replace(mkvmerge, 'mkvmerge'),
+                         'qp_lines': ac.qp_lines, 'chapters': ac.chapters,
+                         'xml_chapters': ''.join(ac.iter_xml_chapter_lines(ordered=True,
+                                                                           uid_seed=0)),
+                         'xml_chapters_unordered': ''.join(ac.iter_xml_chapter_lines(
+                             uid_seed=0)),
+                         'mkvmerge_calls': logged_calls([(os.path.join(work, 'golden.mka'),
+                                                          '<out>'), (audio, '<audio>')]),
+                         'review': review}
+        # After ready_qp_and_chapters(), like example.vpy, so an IVTC'd framerate shows up
+        ac.cut_audio(os.path.join(work, 'golden.aac'), audio_source=raw_audio)
+        results[name]['native_cut'] = native_output(os.path.join(work, 'golden.aac'))
+        if name == 'example':
+            results['linked_chapters'] = {'xml_chapters': ''.join(ac.iter_xml_chapter_lines(
+                links={0: ('0x' + '0123456789abcdef' * 2, 90, 'OP'),
+                       8: ('fedcba9876543210' * 2, '89.5')}, uid_seed=0))}
+    results['vfr'] = golden_vfr(ac_mod, work, raw_audio)
+    results['probe_cache'] = golden_probe_cache(ac_mod, work)
+    results['result_cache'] = golden_result_cache(ac_mod, work, raw_audio)
+    return results
+
+
+def golden_vfr(ac_mod, work, raw_audio):
+    """A variable framerate source: 30p, then 24p, then 30p again, trimmed across the changes."""
+    durations = [(1001, 30000)] * 300 + [(1001, 24000)] * 300 + [(1001, 30000)] * 300
+    tl = ac_mod.Timeline()
+    tl.set_timestamps(ac_mod.TimestampIndex.from_durations(durations))
+    tl.set_trims([(10, 250, 'A'), (280, 560, 'B'), (600, 899)])
+    tl.prepare_cut()
+    tl.ready_qp_and_chapters()
+    timecodes = os.path.join(work, 'golden_tc.txt')
+    tl.write_timecodes(timecodes)
+    with open(timecodes) as f:
+        timecodes = f.read()
+    tl.cut_audio(os.path.join(work, 'golden_vfr.aac'), audio_source=raw_audio)
+    return {'cut_cmd': tl.cut_cmd.replace(ac_mod.MKVMERGE, 'mkvmerge'),
+            'chapters': tl.chapters, 'qp_lines': tl.qp_lines,
+            'xml_chapters': ''.join(tl.iter_xml_chapter_lines(uid_seed=0)),
+            'timecodes': timecodes,
+            'native_cut': native_output(os.path.join(work, 'golden_vfr.aac'))}
+
+
+def golden_probe_cache(ac_mod, work):
+    """Cuts audio found by video_source twice, with a fresh ProbeCache on the same file each time.
+
+    The second run should find the audio and its track without asking mkvmerge, and only save
+    when the entries were used once flush() is called.
+    """
+    folder = os.path.join(work, 'probe')
+    os.makedirs(folder)
+    video = os.path.join(folder, 'episode.ts')
+    with open(video, 'wb') as f:
+        f.write(b'not really a transport stream')
+    for name, size in (('episode T80 DELAY -24ms.aac', 300), ('episode.ac3', 200)):
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(b'a' * size)
+    path = os.path.join(folder, 'probe.json')
+    scrub = [(folder + os.sep, '<probe>/'), (folder + '/', '<probe>/')]
+    result = {}
+    for run in ('first', 'second'):
+        cache = ac_mod.ProbeCache(path)
+        tl = ac_mod.Timeline([(100, 900), (1200, 1700)])
+        tl.probe_cache = cache
+        logged_calls()
+        tl.cut_audio(os.path.join(folder, run + '.mka'), video_source=video)
+        result[run + '_calls'] = logged_calls(scrub + [(os.path.join(folder, run + '.mka'),
+                                                        '<out>')])
+        if run == 'first':
+            # As if the entries were last used long ago
+            with open(path) as f:
+                entries = json.load(f)
+            for entry in entries.values():
+                entry['used'] = 0
+            with open(path, 'w') as f:
+                json.dump(entries, f)
+    with open(path) as f:
+        result['used_saved_before_flush'] = any(e['used'] for e in json.load(f).values())
+    cache.flush()
+    with open(path) as f:
+        entries = json.load(f)
+    result['used_saved_after_flush'] = all(e['used'] for e in entries.values())
+    result['entries'] = sorted([json.loads(k)[0], e['value'] if json.loads(k)[0] == 'identify'
+                                else os.path.basename(e['value'][0])]
+                               for k, e in entries.items())
+    return result
+
+
+def golden_result_cache(ac_mod, work, raw_audio):
+    """Cuts the same audio three times with a ResultCache, the last time after IVTC.
+
+    Only the first should do any cutting, and every output should be the same.
+    """
+    cache = ac_mod.ResultCache(os.path.join(work, 'results'))
+    tl = ac_mod.Timeline([(1159, 6910), (6913, 9609), (11862, 21298)])
+    tl.result_cache = cache
+    outputs = []
+    cuts = []
+    for run in ('miss', 'hit', 'ivtc'):
+        if run == 'ivtc':
+            tl.ready_qp_and_chapters(24000, 1001)
+        out = os.path.join(work, 'golden_{}.aac'.format(run))
+        tl.cut_audio(out, audio_source=raw_audio)
+        outputs.append(native_output(out))
+        logged_calls()
+        tl.cut_audio(os.path.join(work, 'golden_{}.mka'.format(run)), audio_source=raw_audio,
+                     native=False)
+        cuts.append(len([call for call in logged_calls() if '-o' in call]))
+    stats = cache.stats
+    return {'native_cut': outputs[0], 'same_output': all(o == outputs[0] for o in outputs),
+            'mkvmerge_cuts': cuts, 'stats': {k: stats[k] for k in ('hits', 'misses', 'entries')}}
+
+
+def check_golden(results, update):
+    """Compares results with the golden file, or replaces it. Returns True if all is well."""
+    if update or not os.path.exists(GOLDEN):
+        with open(GOLDEN, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('Golden output written to {}'.format(GOLDEN))
+        return True
+    with open(GOLDEN) as f:
+        golden = json.load(f)
+    ok = True
+    for name in sorted(set(golden) | set(results)):
+        for key in sorted(set(golden.get(name, {})) | set(results.get(name, {}))):
+            if golden.get(name, {}).get(key) != results.get(name, {}).get(key):
+                print('GOLDEN MISMATCH: {} {}'.format(name, key))
+                ok = False
+    if ok:
+        print('Golden output matches for {} cases'.format(len(golden)))
+    return ok
+
+
+def last_run(path):
+    """The most recent run recorded in the results file, or None."""
+    try:
+        with open(path) as f:
+            lines = [line for line in f if line.strip()]
+    except IOError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark and regression check for audiocutter.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 10, 100, 1000, 10000],
+                        help='trim counts to time (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per stage, the best one is kept (default: %(default)s)')
+    parser.add_argument('--cut-limit', type=int, default=10000,
+                        help='largest trim count to actually run cut_audio() with '
+                             '(default: %(default)s)')
+    parser.add_argument('--results', default=os.path.join(HERE, 'benchmark_results.jsonl'),
+                        help='file the timings are appended to (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='flag stages this many times slower than last run (default: %(default)s)')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='rewrite the golden output instead of checking it')
+    args = parser.parse_args(argv)
+
+    ac_mod = load_audiocutter()
+    work = tempfile.mkdtemp(prefix='audiocutter-bench-')
+    try:
+        os.environ['FAKE_MKVMERGE_LOG'] = os.path.join(work, 'mkvmerge.log')
+        mkvmerge = make_fake_mkvmerge(work)
+        ac_mod.MKVMERGE = mkvmerge
+        audio = os.path.join(work, 'source DELAY -56ms.aac').replace('\\', '/')
+        with open(audio, 'wb') as f:
+            f.write(b'not really aac')
+        raw_audio = os.path.join(work, 'raw.aac')
+        make_adts(raw_audio, 30 * 60)
+
+        golden_ok = check_golden(golden_output(ac_mod, work, mkvmerge, audio, raw_audio),
+                                 args.update_golden)
+
+        previous = last_run(args.results)
+        previous = {(r['stage'], r['trims'], r['ordered']): r['seconds']
+                    for r in previous['results']} if previous else {}
+        results = []
+        slower = 0
+        print('{:<22} {:>6} {:>9} {:>11} {:>8}'.format('stage', 'trims', 'ordered', 'seconds',
+                                                     'vs last'))
+        for count in args.counts:
+            for ordered in (True, False):
+                timings = run_stages(ac_mod, count, ordered, work, audio, raw_audio, args.repeat,
+                                     args.cut_limit)
+                for stage, seconds in timings.items():
+                    before = previous.get((stage, count, ordered))
+                    ratio = seconds / before if before else None
+                    flag = ' SLOWER' if ratio and ratio > args.threshold else ''
+                    slower += 1 if flag else 0
+                    print('{:<22} {:>6} {:>9} {:>11.6f} {:>8}{}'.format(
+                        stage, count, str(ordered), seconds,
+                        '{:.2f}x'.format(ratio) if ratio else '-', flag))
+                    results.append({'stage': stage, 'trims': count, 'ordered': ordered,
+                                    'seconds': seconds})
+
+        with open(args.results, 'a') as f:
+            f.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'results': results}) + '\n')
+        if slower:
+            print('{} stage(s) slower than the last run by more than {}x'.format(
+                slower, args.threshold))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return 0 if golden_ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())